@@ -1,7 +1,9 @@
 import logging
 
+import numpy as np
 import datajoint as dj
 import hashlib
+from collections import OrderedDict
 
 log = logging.getLogger(__name__)
 
@@ -70,4 +72,96 @@ class InsertBuffer(object):
         if etype:
             raise evalue
         else:
-            return self.flush(1)
\ No newline at end of file
+            return self.flush(1)
+
+
+class LRUCache(object):
+    '''
+    LRUCache: a small in-process least-recently-used cache
+
+    Entries can be dropped selectively with `invalidate(predicate)`,
+    e.g. when the underlying database rows change.
+    '''
+    def __init__(self, maxsize=128):
+        self._maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __getitem__(self, key):
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def invalidate(self, predicate=None):
+        '''
+        drop all entries - or only those for which `predicate(key)` is True
+        '''
+        if predicate is None:
+            self._data.clear()
+        else:
+            for k in [k for k in self._data if predicate(k)]:
+                del self._data[k]
+
+
+def bulk_insert(table, data, batch_size=100000, **insert_args):
+    '''
+    bulk_insert: insert columnar data in large batches, without per-row dict construction
+
+    `data` is a NumPy structured array, or a dict of {attribute: column} -
+    columns are (rows,) arrays / lists, scalar values are broadcast to all rows.
+    Batches go through `table.insert` as record arrays, with `insert_args`.
+
+    Returns the number of rows.
+    '''
+    columns = _to_columns(data)
+    n_rows = len(next(iter(columns.values()))) if columns else 0
+
+    rows = np.rec.fromarrays(list(columns.values()), names=list(columns))
+    for start in range(0, n_rows, batch_size):
+        table.insert(rows[start:start + batch_size], **insert_args)
+
+    log.debug('bulk_insert(): {} rows into {}'.format(n_rows, table.__name__ if isinstance(table, type)
+                                                      else table.__class__.__name__))
+    return n_rows
+
+
+def _to_columns(data):
+    '''
+    structured array or dict of columns / scalars -> dict of (rows,) arrays
+    '''
+    if isinstance(data, np.ndarray) and data.dtype.names:
+        return {name: data[name] for name in data.dtype.names}
+
+    def _is_column(v):
+        return isinstance(v, (list, tuple)) or (isinstance(v, np.ndarray) and v.ndim > 0)
+
+    lengths = {len(v) for v in data.values() if _is_column(v)}
+    if len(lengths) > 1:
+        raise ValueError('bulk_insert(): columns of different lengths {}'.format(sorted(lengths)))
+    n_rows = lengths.pop() if lengths else 1
+
+    columns = {}
+    for name, value in data.items():
+        if not _is_column(value):
+            columns[name] = np.full(n_rows, value)
+            continue
+        try:
+            column = np.asarray(value)
+        except ValueError:  # ragged - e.g. blobs
+            column = None
+        if column is None or column.ndim != 1:
+            column = np.empty(n_rows, dtype=object)
+            column[:] = list(value)
+        columns[name] = column
+    return columns
+
@@ -6,15 +6,20 @@ import datajoint as dj
 import pathlib
 import scipy.io as scio
 
+from scipy.spatial import cKDTree
 from tifffile import imread
 
-from . import InsertBuffer
+from . import bulk_insert, LRUCache
 from . import get_schema_name
 
 schema = dj.schema(get_schema_name('ccf'))
 
 log = logging.getLogger(__name__)
 
+CCF_VOXEL_SIZE = 20  # (um)
+
+_ccf_cache = LRUCache(maxsize=8)  # (cache type, path) -> memory-mapped volume | region names | spatial index | ontology
+
 
 @schema
 class CCFLabel(dj.Lookup):
@@ -94,13 +99,25 @@ class CCFAnnotation(dj.Manual):
         version_name = dj.config['custom']['ccf_data_paths']['version_name']
         stack_path = dj.config['custom']['ccf_data_paths']['annotation_tif']
 
-        stack = imread(stack_path)  # load reference stack
+        stack = np.asarray(get_annotation_volume())  # load reference stack - through the .npy cache
 
         log.info('.. loaded stack of shape {} from {}'
                  .format(stack.shape, stack_path))
 
-        # iterate over ccf ontology region id/name records,
+        # label all voxels in one pass: voxel indices sorted by region id (stable - scan order within a region),
+        # each region is then a contiguous slice of the sorted indices
+        flat_stack = stack.ravel()
+        voxel_order = np.argsort(flat_stack, kind='stable')
+        sorted_ids = flat_stack[voxel_order]
+        region_starts = np.concatenate([[0], np.flatnonzero(np.diff(sorted_ids)) + 1])
+        region_counts = np.diff(np.append(region_starts, len(sorted_ids)))
+        stack_region_ids = sorted_ids[region_starts]
+
+        # iterate over ccf ontology region id/name records, present in the stack
         regions = get_ontology_regions()
+        regions = regions[regions.index.isin(stack_region_ids)]
+        region_slices = {int(region_id): slice(start, start + count) for region_id, start, count
+                         in zip(stack_region_ids, region_starts, region_counts)}
         chunksz, ib_args = 50000, {'skip_duplicates': True,
                                    'allow_direct_insert': True}
 
@@ -111,29 +128,21 @@ class CCFAnnotation(dj.Manual):
             log.info('.. loading region {} ({}/{}) ({})'
                      .format(region_id, idx, len(regions), r.region_name))
 
-            # extracting filled volumes from stack in scaled [[x,y,z]] shape,
-            vol = np.array(np.where(stack == region_id)).T[:, [2, 1, 0]] * 20
-
-            if not vol.shape[0]:
-                log.info('.. region {} volume: shape {} - skipping'
-                         .format(region_id, vol.shape))
-                continue
+            # filled volume from the contiguous slice of sorted voxels, in scaled [[x,y,z]] shape
+            vol = np.array(np.unravel_index(voxel_order[region_slices[region_id]],
+                                            stack.shape)).T[:, [2, 1, 0]] * CCF_VOXEL_SIZE
 
             log.info('.. region {} volume: shape {}'.format(region_id, vol.shape))
 
             with dj.conn().transaction:
-                with InsertBuffer(CCF, chunksz, **ib_args) as buf:
-                    for vox in vol:
-                        buf.insert1((CCFLabel.CCF_R3_20UM_ID, *vox))
-                        buf.flush()
-
-                with InsertBuffer(cls, chunksz, **ib_args) as buf:
-                    for vox in vol:
-                        buf.insert1({'ccf_label_id': CCFLabel.CCF_R3_20UM_ID,
-                                     'ccf_x': vox[0], 'ccf_y': vox[1], 'ccf_z': vox[2],
-                                     'annotation_version': version_name,
-                                     'annotation': r.region_name})
-                        buf.flush()
+                bulk_insert(CCF, {'ccf_label_id': CCFLabel.CCF_R3_20UM_ID,
+                                  'ccf_x': vol[:, 0], 'ccf_y': vol[:, 1], 'ccf_z': vol[:, 2]},
+                            batch_size=chunksz, **ib_args)
+                bulk_insert(cls, {'ccf_label_id': CCFLabel.CCF_R3_20UM_ID,
+                                  'ccf_x': vol[:, 0], 'ccf_y': vol[:, 1], 'ccf_z': vol[:, 2],
+                                  'annotation_version': version_name,
+                                  'annotation': r.region_name},
+                            batch_size=chunksz, **ib_args)
 
         log.info('.. done.')
 
@@ -149,3 +158,237 @@ def get_ontology_regions():
 
     return pd.concat([regions, hexcode], axis=1)
 
+
+
+def get_annotation_volume():
+    """
+    Memory-mapped CCF annotation volume of region ids, indexed as [z, y, x] voxels (CCF_VOXEL_SIZE um)
+    Built once from the "annotation_tif" stack and cached as .npy - at "annotation_npy" if set in
+    dj.config['custom']['ccf_data_paths'], next to the tif stack otherwise
+    """
+    ccf_paths = dj.config['custom']['ccf_data_paths']
+    tif_path = pathlib.Path(ccf_paths['annotation_tif'])
+    npy_path = pathlib.Path(ccf_paths.get('annotation_npy') or tif_path.with_suffix('.npy'))
+
+    cache_key = ('volume', str(npy_path))
+    if cache_key not in _ccf_cache:
+        if not npy_path.exists():
+            log.info('.. caching CCF annotation volume {} to {}'.format(tif_path, npy_path))
+            tmp_path = npy_path.with_name(npy_path.stem + '.tmp.npy')
+            np.save(tmp_path, np.ascontiguousarray(imread(str(tif_path))))
+            tmp_path.replace(npy_path)  # atomic - concurrent readers never see a partial file
+        _ccf_cache[cache_key] = np.load(npy_path, mmap_mode='r')
+    return _ccf_cache[cache_key]
+
+
+def get_voxel_index(xyz):
+    """
+    Voxel indices of CCF coordinates, rounded to the nearest voxel
+    :param xyz: (points x 3) ccf_x, ccf_y, ccf_z coordinates (um)
+    :return: (points x 3) int [z, y, x] voxel indices, (points,) bool - in the annotation volume
+    """
+    volume = get_annotation_volume()
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    with np.errstate(invalid='ignore'):
+        zyx = np.rint(xyz[:, ::-1] / CCF_VOXEL_SIZE)
+        in_volume = np.all((zyx >= 0) & (zyx < volume.shape), axis=1)
+    return np.where(in_volume[:, None], zyx, 0).astype(np.int64), in_volume
+
+
+def lookup_regions(xyz):
+    """
+    Vectorized point to region lookup in the memory-mapped annotation volume
+    :param xyz: (points x 3) ccf_x, ccf_y, ccf_z coordinates (um)
+    :return: (points,) int region ids (0 outside of the volume / brain),
+        (points,) object region names (None outside of the brain / for ids not in the ontology)
+    """
+    zyx, in_volume = get_voxel_index(xyz)
+    region_ids = np.where(in_volume, get_annotation_volume()[zyx[:, 0], zyx[:, 1], zyx[:, 2]], 0).astype(np.int64)
+
+    return region_ids, get_region_names(region_ids)
+
+
+def get_region_names(region_ids):
+    """
+    :param region_ids: (regions,) int region ids
+    :return: (regions,) object region names - None for ids not in the ontology
+    """
+    ontology_ids, ontology_names = _get_ontology_names()
+    idx = np.clip(np.searchsorted(ontology_ids, region_ids), 0, len(ontology_ids) - 1)
+    return np.where(ontology_ids[idx] == region_ids, ontology_names[idx], None)
+
+
+def _get_ontology_names():
+    """
+    (regions,) sorted ontology region ids and their names
+    """
+    cache_key = ('regions', dj.config['custom']['ccf_data_paths']['region_csv'])
+    if cache_key not in _ccf_cache:
+        regions = get_ontology_regions().sort_index()
+        _ccf_cache[cache_key] = (regions.index.to_numpy(dtype=np.int64),
+                                 regions.region_name.to_numpy(dtype=object))
+    return _ccf_cache[cache_key]
+
+
+def get_ontology_hierarchy():
+    """
+    Parent of each region of the ontology, from the Allen structure tree csv ("structure_tree_csv" in
+        dj.config['custom']['ccf_data_paths'] - with "id" and "parent_structure_id" columns)
+    :return: dict of {region_id: parent region_id} - None for the root
+    """
+    tree_path = dj.config['custom']['ccf_data_paths'].get('structure_tree_csv')
+    if not tree_path:
+        raise KeyError('No "structure_tree_csv" in dj.config["custom"]["ccf_data_paths"] - no region hierarchy')
+
+    cache_key = ('hierarchy', tree_path)
+    if cache_key not in _ccf_cache:
+        tree = pd.read_csv(tree_path, usecols=['id', 'parent_structure_id'])
+        _ccf_cache[cache_key] = {int(region_id): None if pd.isnull(parent_id) else int(parent_id)
+                                 for region_id, parent_id in zip(tree.id, tree.parent_structure_id)}
+    return _ccf_cache[cache_key]
+
+
+def get_region_ancestors(region_id):
+    """
+    Ancestors of a region in the ontology, from the region itself up to the root
+    """
+    hierarchy = get_ontology_hierarchy()
+    ancestors = []
+    while region_id is not None:
+        ancestors.append(region_id)
+        region_id = hierarchy.get(region_id)
+    return ancestors
+
+
+def rollup_regions(region_ids, parent_ids):
+    """
+    Map regions to the closest of their ancestors (or themselves) among "parent_ids" - e.g. layers to areas
+    :param region_ids: (points,) region ids
+    :param parent_ids: region ids to roll up to
+    :return: (points,) the region id in parent_ids for each of region_ids, 0 for regions under none of them
+    """
+    parent_ids = set(parent_ids)
+    unique_ids, inverse = np.unique(np.asarray(region_ids, dtype=np.int64), return_inverse=True)
+    rolled_up = np.array([next((a for a in get_region_ancestors(int(region_id)) if a in parent_ids), 0)
+                          for region_id in unique_ids], dtype=np.int64)
+    return rolled_up[inverse].reshape(np.shape(region_ids))
+
+
+def get_spatial_index():
+    """
+    CCFSpatialIndex of the annotation volume - built once per process
+    """
+    cache_key = ('spatial_index', str(dj.config['custom']['ccf_data_paths']['annotation_tif']))
+    if cache_key not in _ccf_cache:
+        _ccf_cache[cache_key] = CCFSpatialIndex(get_annotation_volume())
+    return _ccf_cache[cache_key]
+
+
+class CCFSpatialIndex:
+    """
+    Spatial index of the brain regions of a CCF annotation volume, on the region boundary voxels
+        + per region bounding boxes
+        + one KD-tree over the boundary voxels of all regions - radius queries
+        + per region KD-trees over the boundary voxels of the region, built on first use - nearest voxel queries
+    Any voxel of a region closest to an outside point is a boundary voxel of the region, so a region is
+        within a radius of a point either if it contains the point or if one of its boundary voxels is
+    Coordinates are ccf_x, ccf_y, ccf_z (um), voxels at multiples of CCF_VOXEL_SIZE
+    """
+
+    def __init__(self, volume):
+        """
+        :param volume: [z, y, x] annotation volume of region ids - 0 outside of the brain
+        """
+        log.info('CCFSpatialIndex: indexing region boundaries of volume of shape {}'.format(volume.shape))
+        volume = np.asarray(volume)
+
+        # boundary voxels: in the brain, with a face-neighbor of another region or on the edge of the volume
+        is_boundary = np.zeros(volume.shape, dtype=bool)
+        for axis in range(volume.ndim):
+            lower = [slice(None)] * volume.ndim
+            upper = [slice(None)] * volume.ndim
+            lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+            differs = volume[tuple(lower)] != volume[tuple(upper)]
+            is_boundary[tuple(lower)] |= differs
+            is_boundary[tuple(upper)] |= differs
+            first, last = [slice(None)] * volume.ndim, [slice(None)] * volume.ndim
+            first[axis], last[axis] = 0, -1
+            is_boundary[tuple(first)] = is_boundary[tuple(last)] = True
+        is_boundary &= volume != 0
+
+        # boundary voxels grouped by region - stable sort, each region is a contiguous slice
+        voxel_idx = np.flatnonzero(is_boundary)
+        labels = volume.ravel()[voxel_idx]
+        order = np.argsort(labels, kind='stable')
+        labels, voxel_idx = labels[order], voxel_idx[order]
+
+        self.region_ids = labels[np.concatenate([[0], np.flatnonzero(np.diff(labels)) + 1])].astype(np.int64)
+        self._region_starts = np.searchsorted(labels, self.region_ids)
+        self._region_stops = np.searchsorted(labels, self.region_ids, side='right')
+        self._labels = labels.astype(np.int64)
+        self._xyz = np.array(np.unravel_index(voxel_idx, volume.shape)).T[:, ::-1] * CCF_VOXEL_SIZE
+
+        self.bbox_min = np.minimum.reduceat(self._xyz, self._region_starts, axis=0)
+        self.bbox_max = np.maximum.reduceat(self._xyz, self._region_starts, axis=0)
+
+        self._tree = cKDTree(self._xyz)
+        self._region_trees = {}
+
+        log.info('.. {} regions, {} boundary voxels'.format(len(self.region_ids), len(self._xyz)))
+
+    def _region_index(self, region_id):
+        idx = np.searchsorted(self.region_ids, region_id)
+        if idx == len(self.region_ids) or self.region_ids[idx] != region_id:
+            raise KeyError('Region {} not in the annotation volume'.format(region_id))
+        return idx
+
+    def get_bounding_box(self, region_id):
+        """
+        :return: (3,) min and (3,) max voxel coordinates (um) of the region
+        """
+        idx = self._region_index(region_id)
+        return self.bbox_min[idx], self.bbox_max[idx]
+
+    def regions_in_box(self, box_min, box_max):
+        """
+        :return: region ids whose bounding box intersects the box [box_min, box_max] (um)
+        """
+        overlaps = np.all((self.bbox_min <= np.asarray(box_max)) & (self.bbox_max >= np.asarray(box_min)), axis=1)
+        return self.region_ids[overlaps]
+
+    def regions_within(self, xyz, radius):
+        """
+        Regions within radius of any of the points - e.g. of the points along a probe track
+        :param xyz: (points x 3) coordinates (um)
+        :param radius: (um)
+        :return: region ids, region names
+        """
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        neighbors = self._tree.query_ball_point(xyz, radius)
+        neighbor_idx = np.concatenate([np.empty(0, dtype=np.int64)] + [np.asarray(n, dtype=np.int64)
+                                                                        for n in neighbors])
+        region_ids = np.union1d(self._labels[neighbor_idx], lookup_regions(xyz)[0])
+        region_ids = region_ids[region_ids != 0]
+        return region_ids, get_region_names(region_ids)
+
+    def nearest_voxel(self, xyz, region_id):
+        """
+        Nearest voxel of a region to each point
+        :param xyz: (points x 3) coordinates (um)
+        :param region_id: region to search
+        :return: (points,) distances (um), (points x 3) voxel coordinates (um) - 0 and the point voxel for the
+            points in the region
+        """
+        idx = self._region_index(region_id)
+        if region_id not in self._region_trees:
+            self._region_trees[region_id] = cKDTree(self._xyz[self._region_starts[idx]:self._region_stops[idx]])
+        tree = self._region_trees[region_id]
+
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        distances, nearest = tree.query(xyz)
+        voxels = tree.data[nearest]
+
+        in_region = lookup_regions(xyz)[0] == region_id
+        distances[in_region] = 0
+        voxels[in_region] = np.rint(xyz[in_region] / CCF_VOXEL_SIZE) * CCF_VOXEL_SIZE
+        return distances, voxels
@@ -4,7 +4,6 @@ from . import lab, experiment
 from . import get_schema_name
 
 import numpy as np
-from scipy.interpolate import CubicSpline
 
 schema = dj.schema(get_schema_name('ephys'))
 
@@ -131,6 +130,14 @@ class Clustering(dj.Imported):
     clustering_note=null: varchar(2000)  
     """
 
+    class Offset(dj.Part):
+        definition = """
+        # Session time of the first data point used in clustering - Unit.spike_times are relative to it
+        -> master
+        ---
+        clustering_offset: float  # (s)
+        """
+
 
 @schema
 class Unit(dj.Imported):
@@ -172,6 +179,18 @@ class Unit(dj.Imported):
         spike_times : longblob # (s) per-trial spike times relative to trial-start
         """
 
+    @classmethod
+    def get_session_spike_times(cls, units):
+        """
+        Unit spike times in the session clock (the time reference of experiment.SessionTrial and TrackingSync)
+        Only units of a clustering with a known Clustering.Offset are returned
+        :param units: restriction on Unit (e.g. a probe insertion or session key)
+        :return: unit keys, (units,) arrays of spike times (s), ordered by unit
+        """
+        unit_keys, spike_times, offsets = (cls * Clustering.Offset & units).fetch(
+            'KEY', 'spike_times', 'clustering_offset', order_by='unit')
+        return unit_keys, [np.asarray(s, dtype=float).ravel() + offset for s, offset in zip(spike_times, offsets)]
+
 
 @schema
 class PhotoTaggedUnit(dj.Manual):
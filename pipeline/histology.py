@@ -1,4 +1,9 @@
+import logging
+
+import numpy as np
+import pandas as pd
 import datajoint as dj
+from scipy.interpolate import CubicSpline
 
 from . import lab, experiment, ccf, ephys
 from . import get_schema_name
@@ -6,6 +11,8 @@ from . import get_schema_name
 
 schema = dj.schema(get_schema_name('histology'))
 
+log = logging.getLogger(__name__)
+
 
 @schema
 class ElectrodeCCFPosition(dj.Imported):
@@ -19,7 +26,35 @@ class ElectrodeCCFPosition(dj.Imported):
         -> lab.ElectrodeConfig.Electrode
         ---
         -> ccf.CCF
+        -> ccf.CCFBrainRegion.proj(annotation='region_name')
+        """
+
+    @property
+    def key_source(self):
         """
+        Probe insertions with an insertion depth and a labeled probe track
+        """
+        return ephys.ProbeInsertion & ephys.ProbeInsertion.InsertionLocation & LabeledProbeTrack
+
+    def make(self, key):
+        log.debug('ElectrodeCCFPosition.make(): key: {}'.format(key))
+
+        electrode_keys, electrode_shanks, y_coords = (
+                lab.ElectrodeConfig.Electrode * lab.ProbeType.Electrode
+                & (ephys.ProbeInsertion & key)).fetch(
+            'KEY', 'shank', 'y_coord', order_by='electrode')
+
+        xyz = get_probe_positions(key, electrode_shanks,
+                                  np.array([np.nan if y is None else y for y in y_coords], dtype=float))
+
+        in_brain, ccf_entries = get_ccf_entries(xyz)
+        if not in_brain.all():
+            log.info('.. {}/{} electrodes outside of the labeled track or the brain - not positioned'.format(
+                np.sum(~in_brain), len(in_brain)))
+
+        self.insert1(key)
+        self.ElectrodePosition.insert([{**key, **electrode_keys[i], **ccf_entry}
+                                       for i, ccf_entry in zip(np.flatnonzero(in_brain), ccf_entries)])
 
 
 @schema
@@ -41,3 +76,156 @@ class LabeledProbeTrack(dj.Imported):
         ccf_y: float  # (um)
         ccf_z: float  # (um)    
         """
+
+
+@schema
+class UnitCCFPosition(dj.Computed):
+    definition = """
+    # CCF position of a unit - along the labeled track of the shank of its max-amplitude electrode, at unit_posy
+    -> ephys.Unit
+    ---
+    -> [nullable] ccf.CCF
+    -> [nullable] ccf.CCFBrainRegion.proj(annotation='region_name')
+    """
+
+    # computed per probe insertion: all units at once, from the labeled probe track and insertion depth
+    key_source = (ephys.ProbeInsertion & ephys.ProbeInsertion.InsertionLocation
+                  & LabeledProbeTrack & ephys.Unit)
+
+    def make(self, key):
+        log.debug('UnitCCFPosition.make(): key: {}'.format(key))
+
+        unit_keys = (ephys.Unit & key).fetch('KEY', order_by='clustering_method, unit')
+        shanks, unit_posy = (ephys.Unit * lab.ProbeType.Electrode.proj('shank') & key).fetch(
+            'shank', 'unit_posy', order_by='clustering_method, unit')
+
+        in_brain, ccf_entries = get_ccf_entries(get_probe_positions(key, shanks, unit_posy.astype(float)))
+        if not in_brain.all():
+            log.info('.. {}/{} units outside of the labeled track or the brain - no CCF position (NULL)'.format(
+                np.sum(~in_brain), len(in_brain)))
+
+        # units outside of the brain are inserted without position, the insertion is then not populated again
+        entries = [dict(unit_key) for unit_key in unit_keys]
+        for i, ccf_entry in zip(np.flatnonzero(in_brain), ccf_entries):
+            entries[i].update(ccf_entry)
+        self.insert(entries)
+
+
+@schema
+class RegionUnitCount(dj.Computed):
+    definition = """
+    # Number of units of a probe insertion per brain region - materialized for cohort-level queries
+    -> ephys.ProbeInsertion
+    """
+
+    class Region(dj.Part):
+        definition = """
+        -> master
+        -> ccf.CCFBrainRegion.proj(annotation='region_name')
+        -> ephys.UnitQualityType
+        -> ephys.CellType
+        ---
+        unit_count: int
+        """
+
+    # new insertions are counted as their units get positioned - rows of an insertion are to be
+    # deleted and re-populated if its units or cell types change
+    key_source = ephys.ProbeInsertion & UnitCCFPosition
+
+    def make(self, key):
+        log.debug('RegionUnitCount.make(): key: {}'.format(key))
+
+        units = pd.DataFrame((UnitCCFPosition * ephys.Unit.proj('unit_quality') & key
+                              & 'annotation IS NOT NULL').fetch(
+            'clustering_method', 'unit', 'annotation_version', 'annotation', 'unit_quality', as_dict=True),
+            columns=['clustering_method', 'unit', 'annotation_version', 'annotation', 'unit_quality'])
+        cell_types = pd.DataFrame((ephys.UnitCellType & key).fetch(
+            'clustering_method', 'unit', 'cell_type', as_dict=True),
+            columns=['clustering_method', 'unit', 'cell_type'])
+
+        # units without cell type are counted as "not classified", units of several types under each of them
+        units = units.merge(cell_types, on=['clustering_method', 'unit'], how='left').fillna(
+            {'cell_type': 'not classified'})
+        counts = units.groupby(['annotation_version', 'annotation', 'unit_quality', 'cell_type']).size()
+
+        self.insert1(key)
+        self.Region.insert([{**key, **dict(zip(counts.index.names, region)), 'unit_count': count}
+                            for region, count in counts.items()])
+
+    @classmethod
+    def get_counts(cls, restriction=None, by=('annotation', 'unit_quality', 'cell_type')):
+        """
+        Unit counts summed over the insertions in "restriction", grouped by the "by" attributes
+            - any of the Region attributes, e.g. ('annotation', 'subject_id')
+        """
+        return dj.U(*by).aggr(cls.Region & (restriction or {}), unit_count='sum(unit_count)')
+
+
+# ========= HELPER METHODS ======
+
+
+def get_ccf_entries(xyz):
+    """
+    CCF voxels and brain regions of positions, for ccf.CCF and ccf.CCFBrainRegion references
+    :param xyz: (positions x 3) ccf coordinates (um) - NaN for unknown positions
+    :return: (positions,) bool - in the brain, list of dict - ccf.CCF and region attributes of the positions in the brain
+    """
+    _, region_names = ccf.lookup_regions(xyz)
+    in_brain = np.not_equal(region_names, None)
+    voxels = np.rint(xyz[in_brain] / ccf.CCF_VOXEL_SIZE).astype(int) * ccf.CCF_VOXEL_SIZE
+    annotation_version = dj.config['custom']['ccf_data_paths']['version_name']
+
+    return in_brain, [{'ccf_label_id': ccf.CCFLabel.CCF_R3_20UM_ID,
+                       'ccf_x': x, 'ccf_y': y, 'ccf_z': z,
+                       'annotation_version': annotation_version, 'annotation': region_name}
+                      for (x, y, z), region_name in zip(voxels.tolist(), region_names[in_brain])]
+
+
+def get_probe_positions(insertion_key, shanks, y_coords):
+    """
+    CCF positions of sites along the probe of an insertion, from its labeled probe track and insertion depth
+    The first point of each shank track is at the brain surface and the probe tip at |depth| from it
+    :param insertion_key: ephys.ProbeInsertion key
+    :param shanks: (sites,) shank of each site
+    :param y_coords: (sites,) (um) position of each site along its shank, relative to the probe tip
+    :return: (sites x 3) ccf coordinates (um) - NaN off the labeled track
+    """
+    depth = float((ephys.ProbeInsertion.InsertionLocation & insertion_key).fetch1('depth'))
+    track_shanks, ccf_x, ccf_y, ccf_z = (LabeledProbeTrack.Point & insertion_key).fetch(
+        'shank', 'ccf_x', 'ccf_y', 'ccf_z', order_by='shank, `order`')
+    track_xyz = np.column_stack([ccf_x, ccf_y, ccf_z]).astype(float)
+
+    shanks = np.asarray(shanks)
+    xyz = np.full((len(shanks), 3), np.nan)
+    for shank in np.unique(shanks):
+        is_shank = shanks == shank
+        shank_track = track_xyz[track_shanks == shank]
+        if len(shank_track) < 2:
+            log.warning('.. no labeled track for shank {} - skipping its sites'.format(shank))
+            continue
+        xyz[is_shank] = get_track_positions(shank_track, abs(depth) - np.asarray(y_coords)[is_shank])
+    return xyz
+
+
+def get_track_positions(track_xyz, distances):
+    """
+    Positions along a labeled probe track - cubic spline through the track points, parameterized by
+        the cumulative distance between consecutive points
+    :param track_xyz: (points x 3) ordered track points, the first one at the brain surface (um)
+    :param distances: (positions,) distance along the track from its first point (um)
+    :return: (positions x 3) ccf coordinates - NaN beyond the ends of the track
+    """
+    track_xyz = np.asarray(track_xyz, dtype=float)
+    steps = np.linalg.norm(np.diff(track_xyz, axis=0), axis=1)
+    is_distinct = np.concatenate([[True], steps > 0])  # repeated points would make the spline knots non-increasing
+    arc = np.concatenate([[0], np.cumsum(steps)])[is_distinct]
+    track_xyz = track_xyz[is_distinct]
+
+    distances = np.asarray(distances, dtype=float)
+    positions = np.full((len(distances), 3), np.nan)
+    if len(arc) < 2:
+        return positions
+
+    on_track = (distances >= 0) & (distances <= arc[-1])
+    positions[on_track] = CubicSpline(arc, track_xyz, axis=0)(distances[on_track])
+    return positions
@@ -2,7 +2,7 @@ import datajoint as dj
 import logging
 from datetime import datetime
 
-from pipeline import lab, experiment
+from pipeline import lab, experiment, psth
 from pipeline import get_schema_name
 
 from pipeline.ingest import session_ingest, get_loader
@@ -85,6 +85,9 @@ class BehaviorIngestion(dj.Imported):
             experiment.PhotostimEvent.insert([{**key, **photostim_event} for photostim_event in behavior_data['photostim_events']],
                                            allow_direct_insert=True, ignore_extra_fields=True)
 
+            # new trials / photostim events - drop any materialized trial condition of this session
+            psth.TrialCondition.invalidate(key)
+
             # insert into self
             self.insert1(key)
             log.info(f'Inserted behavior data for: {key}')
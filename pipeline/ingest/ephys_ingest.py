@@ -48,7 +48,7 @@ class EphysIngestion(dj.Imported):
             + lab.ElectrodeConfig
         + ProbeInsertion.RecordingSystemSetup
         + LFP and LFP.Channel (if applicable)
-        + Clustering
+        + Clustering and Clustering.Offset (if the loader returns "clustering_offset")
         + Unit and Unit.Waveform
         + PhotoTaggedUnit (if applicable)
         """
@@ -95,6 +95,10 @@ class EphysIngestion(dj.Imported):
                                       'manual_curation': ephys_data['manual_curation'],
                                       'clustering_note': ephys_data['clustering_note']},
                                      allow_direct_insert=True)
+            if ephys_data.get('clustering_offset') is not None:
+                ephys.Clustering.Offset.insert1({**clustering_key,
+                                                 'clustering_offset': ephys_data['clustering_offset']},
+                                                allow_direct_insert=True)
 
             # ---- Units ----
             units = ephys_data['unit']
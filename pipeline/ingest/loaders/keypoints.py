@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pathlib
+
+
+"""
+Reader of pose estimation (e.g. DeepLabCut) keypoint outputs - HDF5 (.h5) or CSV files with multi-index columns
+    (scorer, [individuals,] bodyparts, coords) - coords being x, y and likelihood, one row per frame
+"""
+
+_COORDS = ('x', 'y', 'likelihood')
+
+
+def read_keypoints(filepath):
+    """
+    Read a keypoint file once, and pivot the multi-index columns into (points x frames) arrays in one reshape
+    :param filepath: path to the .h5 or .csv keypoint file
+    :return: dict - "points": (points,) keypoint names ("<individual>_<bodypart>" for multi-animal outputs),
+        "x", "y", "likelihood": (points x frames) float32 arrays
+    """
+    filepath = pathlib.Path(filepath)
+    if filepath.suffix in ('.h5', '.hdf5'):
+        df = pd.read_hdf(filepath)
+    elif filepath.suffix == '.csv':
+        with open(filepath) as f:
+            header_count = 4 if f.readlines(2 ** 16)[1].startswith('individuals') else 3
+        df = pd.read_csv(filepath, header=list(range(header_count)), index_col=0)
+    else:
+        raise ValueError('Unknown keypoint file format: {}'.format(filepath.suffix))
+
+    # drop the scorer level, merge the individuals and bodyparts levels into the point names
+    point_names = ['_'.join(str(c) for c in col[1:-1]) for col in df.columns]
+    df.columns = pd.MultiIndex.from_arrays([point_names, [col[-1] for col in df.columns]])
+
+    points = list(dict.fromkeys(point_names))  # unique, in file order
+    values = df.reindex(columns=pd.MultiIndex.from_product([points, _COORDS])).to_numpy(dtype=np.float32)
+    x, y, likelihood = values.reshape(len(df), len(points), len(_COORDS)).transpose(2, 1, 0)
+
+    return {'points': points, 'x': x, 'y': y, 'likelihood': likelihood}
+
+
+def load_object_keypoints(filepath, objects, likelihood_threshold=0.9, n_frames=None):
+    """
+    Keypoints of experiment objects, formatted for Tracking.ObjectTracking and Tracking.ObjectPoint
+    Samples with a likelihood below threshold are masked (NaN); the object position is the mean of its points
+    :param filepath: path to the .h5 or .csv keypoint file
+    :param objects: dict of {object: list of point names} - object as in lab.ExperimentObject,
+        None for all the points of the file
+    :param likelihood_threshold: likelihood below which samples are masked
+    :param n_frames: number of frames of the tracking - keypoints are NaN padded / truncated to it
+    :return: dict - "ObjectTracking": list of dict (one per object), "ObjectPoint": list of dict (one per point)
+    """
+    keypoints = read_keypoints(filepath)
+    x, y = (np.where(keypoints['likelihood'] >= likelihood_threshold, keypoints[c], np.nan) for c in ('x', 'y'))
+
+    if n_frames is not None:
+        x, y = (np.pad(v[:, :n_frames], ((0, 0), (0, max(0, n_frames - v.shape[1]))), constant_values=np.nan)
+                for v in (x, y))
+
+    point_idx = {p: i for i, p in enumerate(keypoints['points'])}
+
+    object_tracking, object_points = [], []
+    for obj, points in objects.items():
+        idx = np.arange(len(point_idx)) if points is None else np.array([point_idx[p] for p in points])
+        valid_count = np.sum(~np.isnan(x[idx]), axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            object_x = np.where(valid_count, np.nansum(x[idx], axis=0) / valid_count, np.nan)
+            object_y = np.where(valid_count, np.nansum(y[idx], axis=0) / valid_count, np.nan)
+
+        object_tracking.append({'object': obj, 'object_x': object_x, 'object_y': object_y})
+        object_points.extend({'object': obj, 'point_id': point_id, 'point_x': x[i], 'point_y': y[i]}
+                             for point_id, i in enumerate(idx))
+
+    return {'ObjectTracking': object_tracking, 'ObjectPoint': object_points}
@@ -9,6 +9,7 @@ import ast
 import re
 
 from .jrclust import JRCLUST
+from .ttl import load_sync_pulses
 
 
 """
@@ -59,6 +60,10 @@ Any loader class must have the following interfaces:
             + tracking_device
             -- tracking data, to insert in Tracking
             + tracking_timestamps
+            + (optional) sync_pulses: TTL pulses shared with the ephys recording, to insert in TrackingSync
+                + device: (s) pulse times, device clock
+                + session: (s) pulse times, session (ephys) clock
+                + (optional) offset: (s) approximate session - device clock offset - required for periodic pulses
             -- for example, variables to return for WhiskerTracking
                 + whisker_idx
                 + angle 
@@ -86,6 +91,7 @@ Any loader class must have the following interfaces:
             + headstage  
             + clustering_method
             + clustering_time
+            + (optional) clustering_offset: (s) session time of the first data point used in clustering
             + quality_control  
             + manual_curation  
             + clustering_note   
@@ -108,6 +114,9 @@ class TemplateLoader:
 
     tracking_camera = 'My_Camera'
     tracking_fps = 500
+    camera_ttl_suffix = '_cameraTTL.dat'  # camera sync input level, one sample per frame
+    session_ttl_suffix = '_syncTTL.dat'  # sync channel recorded with the ephys data
+    ephys_sampling_rate = 30000  # (Hz) sampling rate of the sync channel
     default_task = 'hf wheel'
 
     def __init__(self, root_data_dir, config={}):
@@ -264,16 +273,29 @@ class TemplateLoader:
                 d[matched_frame_idx] = getattr(trk_mat, var)[matched_wid]
                 whiskers[wid][var] = d
 
-        # ---- Time sync ----
-        # TODO: any time synchronization here
         # ---- return ----
         # Return a list of dictionary
         # each member dict represents tracking data for one tracking device
 
-        return [{'tracking_device': self.tracking_camera,
-                 'tracking_timestamps': frames / self.tracking_fps,
-                 'tracking_files': [tracking_fp.relative_to(self.root_data_dir)],
-                 'WhiskerTracking': [{'whisker_idx': wid, **wdata} for wid, wdata in whiskers.items()]}]
+        all_tracking_data = [{'tracking_device': self.tracking_camera,
+                              'tracking_timestamps': frames / self.tracking_fps,
+                              'tracking_files': [tracking_fp.relative_to(self.root_data_dir)],
+                              'WhiskerTracking': [{'whisker_idx': wid, **wdata} for wid, wdata in whiskers.items()]}]
+
+        # ---- time sync, if the sync channels were recorded ----
+        # TTL pulses of the camera sync input (one sample per frame) and of the ephys sync channel, matched at
+        #  ingestion to map the camera clock to the session clock (tracking.TrackingSync)
+        # file formats and edge detection parameters from dj.config['custom']['sync_ttl'] - see ttl.py
+        camera_ttl_fp = list(tracking_dir.glob(f'{session_basename}*{self.camera_ttl_suffix}'))
+        session_ttl_fp = list(session_dir.rglob(f'{session_basename}*{self.session_ttl_suffix}'))
+        if len(camera_ttl_fp) == 1 and len(session_ttl_fp) == 1:
+            all_tracking_data[0]['sync_pulses'] = load_sync_pulses(
+                camera_ttl_fp[0], all_tracking_data[0]['tracking_timestamps'], session_ttl_fp[0],
+                self.ephys_sampling_rate, **self.config.get('custom', {}).get('sync_ttl', {}))
+            all_tracking_data[0]['tracking_files'].extend(fp[0].relative_to(self.root_data_dir)
+                                                          for fp in (camera_ttl_fp, session_ttl_fp))
+
+        return all_tracking_data
 
     def load_ephys(self, session_dir, subject_name, session_basename):
         spikesorting_dir = session_dir / 'SpikeSorting' / f'{session_basename}'
@@ -340,6 +362,7 @@ class TemplateLoader:
                       'quality_control': False,
                       'manual_curation': True,
                       'clustering_note': '',
+                      'clustering_offset': 0,  # JRCLUST runs on the whole recording, which starts the session clock
                       'unit': jrclust.data['units'],
                       'unit_quality': jrclust.data['unit_notes'],
                       'unit_electrode': jrclust.data['vmax_unit_site'], # no need to use mapping, it's already remapped
@@ -0,0 +1,107 @@
+import numpy as np
+import pathlib
+import scipy.signal as sc_signal
+
+
+# Quadrature decoding: (previous state x current state) -> count increment, state = (A << 1) | B
+# Gray code sequence in the forward direction: 00 -> 01 -> 11 -> 10 -> 00
+# Invalid transitions (both channels changing at once) and no change count as 0
+_QUADRATURE_TRANSITIONS = np.zeros((4, 4), dtype=np.int8)
+for _prev, _cur in ((0, 1), (1, 3), (3, 2), (2, 0)):
+    _QUADRATURE_TRANSITIONS[_prev, _cur] = 1
+    _QUADRATURE_TRANSITIONS[_cur, _prev] = -1
+
+
+class RotaryEncoder:
+    """
+    Reader of rotary encoder recordings of the wheel, as a binary file of either
+        + "counts": (samples,) int32 - cumulative encoder counts
+        + "quadrature": (samples x 2) uint8 - A and B channels TTL levels (0 / non-zero), interleaved
+    The file is memory-mapped and decoded in streaming chunks: wheel position and speed are written
+    in preallocated float32 arrays, and the decoder / speed filter states are carried across the chunks
+    """
+
+    def __init__(self, filepath, data_format='quadrature', sampling_rate=1000,
+                 counts_per_revolution=4096, wheel_diameter=15, speed_cutoff=10, chunk_size=2 ** 20):
+        """
+        :param filepath: path to the binary file
+        :param data_format: "counts" or "quadrature"
+        :param sampling_rate: (Hz)
+        :param counts_per_revolution: encoder counts per wheel revolution (x4 decoding for quadrature data)
+        :param wheel_diameter: (cm)
+        :param speed_cutoff: (Hz) cutoff frequency of the causal low-pass filter of the speed
+        :param chunk_size: number of samples decoded at once
+        """
+        if data_format not in ('counts', 'quadrature'):
+            raise ValueError('Unknown rotary encoder data format: {}'.format(data_format))
+
+        self.filepath = pathlib.Path(filepath)
+        self.data_format = data_format
+        self.sampling_rate = sampling_rate
+        self.cm_per_count = np.pi * wheel_diameter / counts_per_revolution
+        self.speed_cutoff = speed_cutoff
+        self.chunk_size = chunk_size
+
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._decode()
+        return self._data
+
+    def _decode(self):
+        if self.data_format == 'counts':
+            raw = np.memmap(self.filepath, dtype=np.int32, mode='r')
+        else:
+            raw = np.memmap(self.filepath, dtype=np.uint8, mode='r').reshape(-1, 2)
+        n_samples = len(raw)
+
+        position = np.empty(n_samples, dtype=np.float32)
+        speed = np.empty(n_samples, dtype=np.float32)
+
+        sos = sc_signal.butter(2, self.speed_cutoff, btype='lowpass', fs=self.sampling_rate, output='sos')
+        zi = None
+        state, count = None, 0
+        last_position = None  # float64 - carried across chunks
+
+        for start in range(0, n_samples, self.chunk_size):
+            chunk = np.asarray(raw[start:start + self.chunk_size])
+
+            if self.data_format == 'counts':
+                counts = chunk.astype(np.float64)
+            else:
+                counts, state, count = decode_quadrature(chunk[:, 0], chunk[:, 1], state, count)
+
+            chunk_position = counts * self.cm_per_count
+            chunk_speed = np.diff(chunk_position, prepend=chunk_position[0] if last_position is None
+                                  else last_position) * self.sampling_rate
+            last_position = chunk_position[-1]
+
+            if zi is None:
+                # filter initialized at the steady state of the first speed sample
+                zi = sc_signal.sosfilt_zi(sos) * chunk_speed[0]
+            chunk_speed, zi = sc_signal.sosfilt(sos, chunk_speed, zi=zi)
+
+            position[start:start + len(chunk)] = chunk_position
+            speed[start:start + len(chunk)] = chunk_speed
+
+        return {'timestamps': np.arange(n_samples) / self.sampling_rate,
+                'position': position,
+                'speed': speed}
+
+
+def decode_quadrature(a, b, state=None, count=0):
+    """
+    Vectorized decoding of quadrature encoder channels with a state-transition table
+    :param a, b: (samples,) A and B channel levels (0 / non-zero)
+    :param state: encoder state (0-3) preceding the first sample - e.g. from the previous chunk
+    :param count: encoder count preceding the first sample - e.g. from the previous chunk
+    :return: (samples,) cumulative encoder counts, last state, last count
+    """
+    states = ((np.asarray(a) != 0).astype(np.int8) << 1) | (np.asarray(b) != 0)
+    if not len(states):
+        return np.empty(0), state, count
+    previous = np.concatenate([[states[0] if state is None else state], states[:-1]])
+    counts = count + np.cumsum(_QUADRATURE_TRANSITIONS[previous, states], dtype=np.int64)
+    return counts, states[-1], counts[-1]
@@ -0,0 +1,104 @@
+import numpy as np
+import pathlib
+
+
+"""
+Detection of the TTL pulses of recorded sync channels, for the clock synchronization of the tracking devices
+to the session (ephys) clock (tracking.TrackingSync)
+    + session side: a channel of the ephys recording (or of the acquisition board), binary file of
+        (samples x channels) interleaved samples - digital levels or analog voltage
+    + device side: the level of the sync input sampled by the camera at each frame (frame "line status"),
+        binary file of one sample per frame
+"""
+
+
+def detect_ttl_edges(samples, threshold=None, edge='rising', min_interval=1, chunk_size=2 ** 22):
+    """
+    Sample indices of the TTL edges of a channel, detected in streaming chunks (the input can be memory-mapped)
+    :param samples: (samples,) array-like - digital levels or analog voltage
+    :param threshold: level separating low from high - default: midpoint of the channel range
+    :param edge: "rising", "falling" or "both"
+    :param min_interval: (samples) debouncing - edges closer than min_interval to the previous crossing
+        (noise around the threshold of an analog channel) are dropped
+    :param chunk_size: number of samples read at once
+    :return: (edges,) int64 - index of the first sample after each edge
+    """
+    if edge not in ('rising', 'falling', 'both'):
+        raise ValueError('Unknown TTL edge: {}'.format(edge))
+
+    n_samples = len(samples)
+    if threshold is None:
+        low, high = np.inf, -np.inf
+        for start in range(0, n_samples, chunk_size):
+            chunk = np.asarray(samples[start:start + chunk_size])
+            low, high = min(low, chunk.min()), max(high, chunk.max())
+        if not n_samples or low == high:
+            return np.empty(0, dtype=np.int64)
+        threshold = (float(low) + float(high)) / 2
+
+    crossings, directions = [], []
+    previous = None  # level of the last sample of the previous chunk
+    for start in range(0, n_samples, chunk_size):
+        level = np.asarray(samples[start:start + chunk_size]) > threshold
+        change = np.diff(level.astype(np.int8), prepend=level[0] if previous is None else previous)
+        idx = np.flatnonzero(change)
+        crossings.append(idx + start)
+        directions.append(change[idx])
+        previous = level[-1]
+
+    crossings = np.concatenate(crossings).astype(np.int64) if crossings else np.empty(0, dtype=np.int64)
+    directions = np.concatenate(directions) if directions else np.empty(0, dtype=np.int8)
+
+    # debouncing: a crossing following the previous one (of any direction) by less than min_interval is noise
+    keep = np.diff(crossings, prepend=-min_interval) >= min_interval
+    crossings, directions = crossings[keep], directions[keep]
+
+    if edge == 'rising':
+        return crossings[directions > 0]
+    if edge == 'falling':
+        return crossings[directions < 0]
+    return crossings
+
+
+def read_ttl_channel(filepath, dtype='int16', n_channels=1, channel=0):
+    """
+    Memory-mapped sync channel of a binary recording of (samples x channels) interleaved samples
+    :param filepath: path to the binary file
+    :param dtype: sample data type
+    :param n_channels: number of interleaved channels
+    :param channel: index of the sync channel
+    :return: (samples,) memory-mapped array
+    """
+    return np.memmap(pathlib.Path(filepath), dtype=dtype, mode='r').reshape(-1, n_channels)[:, channel]
+
+
+def load_ttl_edges(filepath, dtype='int16', n_channels=1, channel=0, **detect_args):
+    """
+    Sample indices of the TTL edges of the sync channel of a binary recording
+    :param filepath: path to the binary file
+    :param dtype, n_channels, channel: see read_ttl_channel()
+    :param detect_args: see detect_ttl_edges() (threshold, edge, min_interval)
+    :return: (edges,) int64 - index of the first sample after each edge
+    """
+    return detect_ttl_edges(read_ttl_channel(filepath, dtype, n_channels, channel), **detect_args)
+
+
+def load_sync_pulses(device_filepath, device_timestamps, session_filepath, session_sampling_rate,
+                     device_args={}, session_args={}):
+    """
+    TTL pulses shared by a tracking device and the session (ephys) recording, as "sync_pulses" for tracking ingestion
+    :param device_filepath: sync input level of the device, one sample per frame
+    :param device_timestamps: (frames,) frame times, device clock
+    :param session_filepath: recording with the sync channel, session clock
+    :param session_sampling_rate: (Hz) sampling rate of the session recording
+    :param device_args, session_args: load_ttl_edges() arguments of each file
+    :return: dict - "device": (s) pulse times, device clock, "session": (s) pulse times, session clock
+    """
+    device_timestamps = np.asarray(device_timestamps)
+    device_edges = load_ttl_edges(device_filepath, **{'dtype': 'uint8', **device_args})
+    device_edges = device_edges[device_edges < len(device_timestamps)]  # frames past the tracking are dropped
+
+    session_edges = load_ttl_edges(session_filepath, **session_args)
+
+    return {'device': device_timestamps[device_edges],
+            'session': session_edges / session_sampling_rate}
@@ -9,6 +9,9 @@ import ast
 import re
 
 from .jrclust import JRCLUST
+from .rotary_encoder import RotaryEncoder
+from .keypoints import load_object_keypoints
+from .ttl import load_sync_pulses
 
 
 """
@@ -59,6 +62,11 @@ Any loader class must have the following interfaces:
             + tracking_device
             -- tracking data, to insert in Tracking
             + tracking_timestamps
+            + (optional) sync_pulses: TTL pulses shared with the ephys recording, to insert in TrackingSync
+                + device: (s) pulse times, device clock
+                + session: (s) pulse times, session (ephys) clock
+                + (optional) offset: (s) approximate session - device clock offset - required for periodic pulses
+            (see ttl.py for the detection of the pulses from the recorded sync channels)
             -- for example, variables to return for WhiskerTracking
                 + whisker_idx
                 + angle 
@@ -69,6 +77,9 @@ Any loader class must have the following interfaces:
                 + follicle_y 
                 + tip_x    
                 + tip_y
+                + (optional) param_set and processed variables (amplitude, velocity, set_point, angle_raw...)
+            + (optional) WhiskerProcessingParams: dict of the parameters of "param_set", if processed offline
+            -- (optional) ObjectTracking / ObjectPoint, from pose estimation keypoints (see keypoints.py)
             + tracking_files 
 
     `load_ephys` function:  loads processed ephys data
@@ -86,6 +97,7 @@ Any loader class must have the following interfaces:
             + headstage  
             + clustering_method
             + clustering_time
+            + (optional) clustering_offset: (s) session time of the first data point used in clustering
             + quality_control  
             + manual_curation  
             + clustering_note   
@@ -108,6 +120,12 @@ class VincentLoader:
 
     tracking_camera = 'WT_Camera_Vincent 0'
     tracking_fps = 500
+    rotary_encoder = 'Rotary encoder 0'
+    rotary_encoder_rate = 1000
+    whisker_param_set = 'whiskers_vincent'  # WhiskerProcessingParams of the whisker data processed offline
+    keypoint_likelihood_threshold = 0.9  # pose estimation samples of lower likelihood are masked (NaN)
+    camera_ttl_suffix = '_cameraTTL.dat'  # camera sync input level, one sample per frame
+    session_ttl_suffix = '_syncTTL.dat'  # sync channel recorded with the ephys data
     default_task = 'hf wheel'
     default_task_protocol = 0
 
@@ -242,8 +260,8 @@ class VincentLoader:
                  'photostim_events': photostim_events}]
 
     def load_tracking(self, session_dir, subject_name, session_basename):
-        # TODO: decide where wheel position data from rotary encoder goes.
-        #  For now, this is considered tracking data, although it's not video based.
+        # wheel position data from the rotary encoder is considered tracking data (PositionTracking),
+        #  although it's not video based
 
         # ---- identify the .mat file for tracking data ----
         tracking_dir = session_dir / 'Analysis' / session_basename
@@ -269,13 +287,18 @@ class VincentLoader:
         input_procvar = ['amplitude', 'velocity', 'setPoint', 'angle_raw', 'angle_BP', 'freq', 'phase']
         output_procvar = ['amplitude', 'velocity', 'set_point', 'angle_raw', 'angle_bp', 'frequency', 'phase']
 
+        # parameters of the offline (Matlab) processing, from dj.config['custom']['whisker_processing_params']
+        #  - without them, the processed variables are not loaded, and ProcessedWhisker is computed by the pipeline
+        processing_params = self.config.get('custom', {}).get('whisker_processing_params', {}).get(
+            self.whisker_param_set)
+
         for wid in whisker_inds:
 
             for invar,outvar in zip(input_varnames,output_varnames):
                 whiskers[wid][outvar] = getattr(wtracking_data[wid], invar)
 
-            if 'phase' in wtracking_data[wid]._fieldnames:
-                whiskers[wid]['param_set'] = 'whiskers_vincent' # name of set of processing parameters for WhiskerProcessingParams
+            if processing_params and 'phase' in wtracking_data[wid]._fieldnames:
+                whiskers[wid]['param_set'] = self.whisker_param_set # name of set of processing parameters for WhiskerProcessingParams
                 for invar, outvar in zip(input_procvar, output_procvar):
                     whiskers[wid][outvar] = getattr(wtracking_data[wid], invar)
 
@@ -283,10 +306,54 @@ class VincentLoader:
         # Return a list of dictionary
         # each member dict represents tracking data for one tracking device
 
-        return [{'tracking_device': self.tracking_camera,
-                 'tracking_timestamps': wtracking_data[0].timestamp,
-                 'tracking_files': [tracking_fp.relative_to(self.root_data_dir)],
-                 'WhiskerTracking': [{'whisker_idx': wid, **wdata} for wid, wdata in whiskers.items()]}]
+        all_tracking_data = [{'tracking_device': self.tracking_camera,
+                              'tracking_timestamps': wtracking_data[0].timestamp,
+                              'tracking_files': [tracking_fp.relative_to(self.root_data_dir)],
+                              'WhiskerTracking': [{'whisker_idx': wid, **wdata} for wid, wdata in whiskers.items()]}]
+        if processing_params:
+            all_tracking_data[0]['WhiskerProcessingParams'] = {'param_set': self.whisker_param_set,
+                                                               **processing_params}
+
+        # ---- time sync, if the sync channels were recorded ----
+        # TTL pulses of the camera sync input (line status, one sample per frame) and of the ephys sync channel
+        # file formats and edge detection parameters from dj.config['custom']['sync_ttl'] - see ttl.py
+        camera_ttl_fp = list(tracking_dir.glob(f'{session_basename}*{self.camera_ttl_suffix}'))
+        session_ttl_fp = list(session_dir.rglob(f'{session_basename}*{self.session_ttl_suffix}'))
+        sessioninfo_fp = list(session_dir.glob(f'{session_basename}*.json'))
+        if len(camera_ttl_fp) == 1 and len(session_ttl_fp) == 1 and len(sessioninfo_fp) == 1:
+            with open(sessioninfo_fp[0]) as f:
+                sampling_rate = json.load(f)['samplingRate']
+            all_tracking_data[0]['sync_pulses'] = load_sync_pulses(
+                camera_ttl_fp[0], all_tracking_data[0]['tracking_timestamps'], session_ttl_fp[0], sampling_rate,
+                **self.config.get('custom', {}).get('sync_ttl', {}))
+            all_tracking_data[0]['tracking_files'].extend(fp[0].relative_to(self.root_data_dir)
+                                                          for fp in (camera_ttl_fp, session_ttl_fp))
+
+        # ---- object keypoints (pose estimation), if any ----
+        # {object: keypoint names (None for all)} from dj.config['custom']['keypoint_objects']
+        # DeepLabCut output files are named after the video: <session_basename>...DLC_<network>....h5 (or .csv)
+        keypoint_objects = self.config.get('custom', {}).get('keypoint_objects')
+        keypoint_fp = (sorted(tracking_dir.glob(f'{session_basename}*DLC*.h5'))
+                       or sorted(tracking_dir.glob(f'{session_basename}*DLC*.csv')))
+        if keypoint_objects and keypoint_fp:
+            all_tracking_data[0].update(load_object_keypoints(
+                keypoint_fp[0], keypoint_objects, self.keypoint_likelihood_threshold,
+                n_frames=len(all_tracking_data[0]['tracking_timestamps'])))
+            all_tracking_data[0]['tracking_files'].append(keypoint_fp[0].relative_to(self.root_data_dir))
+
+        # ---- rotary encoder (wheel) data, if any ----
+        # encoder parameters (data_format, counts_per_revolution, wheel_diameter...) from dj.config['custom']
+        encoder_fp = list(tracking_dir.glob(f'{session_basename}*_encoder.dat'))
+        if encoder_fp:
+            encoder = RotaryEncoder(encoder_fp[0], sampling_rate=self.rotary_encoder_rate,
+                                    **self.config.get('custom', {}).get('rotary_encoder', {}))
+            all_tracking_data.append({'tracking_device': self.rotary_encoder,
+                                      'tracking_timestamps': encoder.data['timestamps'],
+                                      'tracking_files': [encoder_fp[0].relative_to(self.root_data_dir)],
+                                      'PositionTracking': {'position_x': encoder.data['position'],
+                                                           'speed': encoder.data['speed']}})
+
+        return all_tracking_data
 
     def load_ephys(self, session_dir, subject_name, session_basename):
         spikesorting_dir = session_dir / 'SpikeSorting' / f'{session_basename}'
@@ -353,6 +420,7 @@ class VincentLoader:
                       'quality_control': False,
                       'manual_curation': True,
                       'clustering_note': '',
+                      'clustering_offset': 0,  # JRCLUST runs on the whole recording, which starts the session clock
                       'unit': jrclust.data['units'],
                       'unit_quality': jrclust.data['unit_notes'],
                       'unit_electrode': jrclust.data['vmax_unit_site'], # no need to use mapping, it's already remapped
@@ -9,6 +9,7 @@ import ast
 import re
 
 #from .jrclust import JRCLUST
+from .ttl import load_sync_pulses
 
 
 """
@@ -59,6 +60,10 @@ Any loader class must have the following interfaces:
             + tracking_device
             -- tracking data, to insert in Tracking
             + tracking_timestamps
+            + (optional) sync_pulses: TTL pulses shared with the ephys recording, to insert in TrackingSync
+                + device: (s) pulse times, device clock
+                + session: (s) pulse times, session (ephys) clock
+                + (optional) offset: (s) approximate session - device clock offset - required for periodic pulses
             -- for example, variables to return for WhiskerTracking
                 + whisker_idx
                 + angle 
@@ -108,6 +113,9 @@ class WenxiLoader:
 
     tracking_camera = 'WX_acA800-510um_0' #TODO: specify here tracking device (to be added in tracking.py > TrackingDevice). Or pass that information to tracking_ingest function
     tracking_fps = 500
+    camera_ttl_suffix = '_cameraTTL.dat'  # camera sync input level, one sample per frame
+    session_ttl_suffix = '_syncTTL.dat'  # sync channel recorded with the ephys data
+    ephys_sampling_rate = 30000  # (Hz) sampling rate of the sync channel
     default_task = 'hf wall dist' #TODO: describe task protocol used in experiment.py > Task > TaskProtocol
     default_task_protocol = 100
 
@@ -241,16 +249,29 @@ class WenxiLoader:
         """ # TODO: write code to load wall and other tracking data
         """
 
-        # ---- Time sync ----
-        # TODO: any time synchronization here
         # ---- return ----
         # Return a list of dictionary
         # each member dict represents tracking data for one tracking device
 
-        return [{'tracking_device': self.tracking_camera,
-                 'tracking_timestamps': frames / self.tracking_fps,
-                 'tracking_files': [tracking_fp.relative_to(self.root_data_dir)],
-                 'WhiskerTracking': [{'whisker_idx': wid, **wdata} for wid, wdata in whiskers.items()]}]
+        all_tracking_data = [{'tracking_device': self.tracking_camera,
+                              'tracking_timestamps': frames / self.tracking_fps,
+                              'tracking_files': [tracking_fp.relative_to(self.root_data_dir)],
+                              'WhiskerTracking': [{'whisker_idx': wid, **wdata} for wid, wdata in whiskers.items()]}]
+
+        # ---- time sync, if the sync channels were recorded ----
+        # TTL pulses of the camera sync input (one sample per frame) and of the ephys sync channel, matched at
+        #  ingestion to map the camera clock to the session clock (tracking.TrackingSync)
+        # file formats and edge detection parameters from dj.config['custom']['sync_ttl'] - see ttl.py
+        camera_ttl_fp = list(tracking_dir.glob(f'{session_basename}*{self.camera_ttl_suffix}'))
+        session_ttl_fp = list(session_dir.rglob(f'{session_basename}*{self.session_ttl_suffix}'))
+        if len(camera_ttl_fp) == 1 and len(session_ttl_fp) == 1:
+            all_tracking_data[0]['sync_pulses'] = load_sync_pulses(
+                camera_ttl_fp[0], all_tracking_data[0]['tracking_timestamps'], session_ttl_fp[0],
+                self.ephys_sampling_rate, **self.config.get('custom', {}).get('sync_ttl', {}))
+            all_tracking_data[0]['tracking_files'].extend(fp[0].relative_to(self.root_data_dir)
+                                                          for fp in (camera_ttl_fp, session_ttl_fp))
+
+        return all_tracking_data
 
     def load_ephys(self, session_dir, subject_name, session_basename):
         """ # TODO: change this code block according to your file formats and folder structure
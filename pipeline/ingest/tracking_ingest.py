@@ -44,6 +44,8 @@ class TrackingIngestion(dj.Imported):
             + TrackingDevice
             + Tracking
                 + tracking_timestamps
+            + TrackingSync (if the loader returns "sync_pulses")
+            + WhiskerProcessingParams (if the loader returns whisker data processed offline, with their parameters)
                 -- any of the following subclasses -- 
                 + PositionTracking
                 + ObjectTracking
@@ -69,6 +71,8 @@ class TrackingIngestion(dj.Imported):
         for tracking_data in all_tracking_data:
             # ---- extract information from the imported data (from loader class) ----
             tracking_files.extend(tracking_data.pop('tracking_files'))
+            sync_pulses = tracking_data.pop('sync_pulses', None)
+            processing_params = tracking_data.pop('WhiskerProcessingParams', None)
             part_tbl_data = {tbl_name: tracking_data.pop(tbl_name)
                              for tbl_name in tracking.Tracking().tracking_features
                              if tbl_name in tracking_data}
@@ -77,19 +81,32 @@ class TrackingIngestion(dj.Imported):
             # insert to the main Tracking
             tracking.Tracking.insert1({**key, **tracking_data},
                                       allow_direct_insert=True, ignore_extra_fields=True)
+            # clock synchronization of the device to the session (ephys) clock, from shared TTL pulses
+            if sync_pulses is not None:
+                sync = tracking.TrackingSync.fit(sync_pulses['device'], sync_pulses['session'],
+                                                 offset=sync_pulses.get('offset'))
+                log.info('Tracking sync {}: {} pulses matched, rms residual {:.2g} s'.format(
+                    tracking_data['tracking_device'], sync['pulse_count'], sync['residual_rms']))
+                tracking.TrackingSync.insert1({**key, 'tracking_device': tracking_data['tracking_device'], **sync},
+                                              allow_direct_insert=True)
+            else:
+                log.warning('Tracking sync {}: no "sync_pulses" from the loader - tracking clock assumed'
+                            ' synchronized to the session clock'.format(tracking_data['tracking_device']))
             # insert to the Tracking part-tables (different tracked features)
             for tbl_name, tbl_data in part_tbl_data.items():
                 part_tbl = tracking.Tracking().tracking_features[tbl_name]
                 if isinstance(tbl_data, dict):
-                    part_tbl.insert1({**key, **tracking_data, **tbl_data},
-                                     allow_direct_insert=True, ignore_extra_fields=True)
-                    tracking.ProcessedWhisker.insert1({**key, **tracking_data, **tbl_data},
-                                     allow_direct_insert=True, ignore_extra_fields=True)
-                elif isinstance(tbl_data, list):
-                    part_tbl.insert([{**key, **tracking_data, **d} for d in tbl_data],
-                                    allow_direct_insert=True, ignore_extra_fields=True)
-                    tracking.ProcessedWhisker.insert([{**key, **tracking_data, **d} for d in tbl_data],
-                                    allow_direct_insert=True, ignore_extra_fields=True)
+                    tbl_data = [tbl_data]
+                part_tbl.insert([{**key, **tracking_data, **d} for d in tbl_data],
+                                allow_direct_insert=True, ignore_extra_fields=True)
+                # whisker data already processed by the loader (with a "param_set") go directly to ProcessedWhisker
+                # others are computed by ProcessedWhisker.populate()
+                processed_data = [d for d in tbl_data if 'param_set' in d]
+                if tbl_name == 'WhiskerTracking' and processed_data:
+                    if processing_params is not None:
+                        tracking.WhiskerProcessingParams.insert1(processing_params, skip_duplicates=True)
+                    tracking.ProcessedWhisker.insert([{**key, **tracking_data, **d} for d in processed_data],
+                                                     allow_direct_insert=True, ignore_extra_fields=True)
 
         # insert into self
         self.insert1(key)
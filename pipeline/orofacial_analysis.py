@@ -0,0 +1,498 @@
+import os
+import logging
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import datajoint as dj
+
+from . import (experiment, ephys, tracking)
+[experiment, ephys, tracking]  # NOQA
+
+from . import get_schema_name
+
+schema = dj.schema(get_schema_name('orofacial_analysis'))
+log = logging.getLogger(__name__)
+
+
+@schema
+class WhiskingPhaseLocking(dj.Computed):
+    definition = """
+    # Locking of the unit spikes to the whisking phase (ProcessedWhisker.phase) of a tracked whisker
+    -> ephys.Unit
+    -> tracking.ProcessedWhisker
+    ---
+    spike_count:            int         # number of spikes during whisking (amplitude above min_amplitude)
+    phase_histogram:        longblob    # (phase_bins,) spike count per phase bin, from -pi to pi
+    vector_strength=null:   float       # mean resultant length of the spike phases, in [0, 1]
+    preferred_phase=null:   float       # (rad) circular mean of the spike phases
+    shuffle_p_value=null:   float       # p-value of the vector strength against the circular shuffle null
+    """
+
+    phase_bin_count = 36  # number of bins of the phase histograms
+    min_amplitude = 2.5  # (deg) whisking amplitude below which spikes are discarded (no whisking)
+    shuffle_count = 1000  # number of circular shuffles of the spike trains relative to the whisker phase
+    min_shift = 1  # (s) minimum circular shift of the shuffles
+    random_seed = 0
+    max_batch_size = int(5e7)  # max number of (shuffle x spike x 3 x whisker) float64 elements per batch - 400 MB
+
+    # computed per session: all units x all whiskers at once - units of a known offset to the session clock
+    key_source = (experiment.Session & (ephys.Unit & 'unit_quality != "all"' & ephys.Clustering.Offset)
+                  & tracking.ProcessedWhisker)
+
+    def make(self, key):
+        log.debug('WhiskingPhaseLocking.make(): key: {}'.format(key))
+
+        # spike times shifted by the clustering offset to the session clock (the reference of TrackingSync)
+        units, spike_times = ephys.Unit.get_session_spike_times(ephys.Unit & key & 'unit_quality != "all"')
+
+        spikes = np.concatenate(spike_times)
+        unit_idx = np.repeat(np.arange(len(units)), [np.size(s) for s in spike_times])
+
+        rng = np.random.default_rng(self.random_seed)
+
+        entries = []
+        for tracking_key in (tracking.Tracking & key & tracking.ProcessedWhisker).fetch('KEY'):
+            timestamps = tracking.TrackingSync.get_timestamps(tracking_key)
+            whisker_keys, phases, amplitudes = (tracking.ProcessedWhisker & tracking_key).fetch(
+                'KEY', 'phase', 'amplitude', order_by='whisker_idx')
+            phase = np.vstack([np.asarray(p, dtype=float).ravel() for p in phases])
+            whisking = np.vstack([np.asarray(a, dtype=float).ravel() for a in amplitudes]) > self.min_amplitude
+
+            frame, in_tracking = _get_spike_frames(spikes, timestamps)
+            frame, spike_unit_idx = frame[in_tracking], unit_idx[in_tracking]
+
+            fs = 1 / np.median(np.diff(timestamps))
+            shifts = rng.integers(int(self.min_shift * fs),
+                                  max(len(timestamps) - int(self.min_shift * fs), int(self.min_shift * fs) + 1),
+                                  size=self.shuffle_count)
+
+            stats = compute_phase_locking(phase, whisking, frame, spike_unit_idx, len(units),
+                                          self.phase_bin_count, shifts, self.max_batch_size)
+
+            for w, whisker_key in enumerate(whisker_keys):
+                for u, unit_key in enumerate(units):
+                    entries.append({**unit_key, **whisker_key,
+                                    **{k: v[w, u] for k, v in stats.items()}})
+
+        self.insert(entries)
+
+
+@schema
+class GlmParamSet(dj.Lookup):
+    definition = """
+    glm_param_set:      varchar(30)
+    ---
+    bin_size:           decimal(6, 4)   # (s) common time bin of the spike counts and of the regressors
+    lag_edges:          blob            # (s) lag window edges (multiples of bin_size) - positive: after the spike
+    ridge:              float           # L2 penalty of the coefficients (not of the intercept)
+    fold_count:         tinyint         # number of (contiguous) cross-validation folds
+    """
+
+    contents = [('default', 0.02, np.array([-0.1, -0.06, -0.02, 0, 0.02, 0.06, 0.1]), 1, 5)]
+
+
+@schema
+class UnitKinematicsGlm(dj.Computed):
+    definition = """
+    # Poisson GLM of the unit spike counts on the lagged whisker kinematics of a Tracking - angle, set point,
+    # amplitude, phase (cos, sin) of each ProcessedWhisker, and touch (any object, if WhiskerObjectDistance)
+    -> ephys.Unit
+    -> tracking.Tracking
+    -> GlmParamSet
+    ---
+    regressors:                     longblob    # (regressors,) regressor names, "intercept" first
+    coefficients:                   longblob    # (regressors,) coefficients of the fit on all bins
+    cv_deviance:                    float       # held-out Poisson deviance, summed over the cross-validation folds
+    cv_null_deviance:               float       # held-out Poisson deviance of the (train) mean rate model
+    cv_deviance_explained=null:     float       # 1 - cv_deviance / cv_null_deviance
+    """
+
+    unit_batch_size = 8  # number of units fitted together (vectorized) per process pool task
+    max_iter = 100
+    tol = 1e-6
+
+    @property
+    def key_source(self):
+        """
+        Populated per (session, glm_param_set): one design matrix per Tracking, shared by all the units,
+        fitted in a process pool (number of processes: dj.config['custom']['glm.n_workers'],
+        default to the number of CPUs)
+        """
+        return (experiment.Session & (ephys.Unit & 'unit_quality != "all"' & ephys.Clustering.Offset)
+                & tracking.ProcessedWhisker) * GlmParamSet.proj()
+
+    def make(self, key):
+        log.debug('UnitKinematicsGlm.make(): key: {}'.format(key))
+
+        params = (GlmParamSet & key).fetch1()
+        bin_size = float(params['bin_size'])
+        lag_edges = np.asarray(params['lag_edges'], dtype=float).ravel()
+
+        # spike times shifted by the clustering offset to the session clock (the reference of TrackingSync)
+        units, spike_times = ephys.Unit.get_session_spike_times(ephys.Unit & key & 'unit_quality != "all"')
+
+        n_workers = dj.config['custom'].get('glm.n_workers', os.cpu_count())
+
+        entries = []
+        for tracking_key in (tracking.Tracking & key & tracking.ProcessedWhisker).fetch('KEY'):
+            timestamps = tracking.TrackingSync.get_timestamps(tracking_key)
+            variables = _get_kinematics(tracking_key)
+
+            bin_edges, design, regressors = build_kinematics_design(timestamps, variables, bin_size, lag_edges)
+            n_bins = len(bin_edges) - 1
+
+            # spike bins of each unit - the spike counts are built in the workers
+            spike_bins = [np.searchsorted(bin_edges, s, side='right') - 1 for s in spike_times]
+            spike_bins = [b[(b >= 0) & (b < n_bins)] for b in spike_bins]
+
+            # contiguous cross-validation folds, plus a fit on all bins - Gram matrix eigendecompositions shared
+            # by all units
+            fold_idx = np.minimum(np.arange(n_bins) * params['fold_count'] // n_bins, params['fold_count'] - 1)
+            train_mask = fold_idx[:, None] != np.arange(params['fold_count'] + 1)[None, :]
+            gram_eigs = [np.linalg.eigh(design[train].T @ design[train]) for train in train_mask.T]
+
+            shared = (design, train_mask, gram_eigs, float(params['ridge']), self.max_iter, self.tol)
+            tasks = [spike_bins[start:start + self.unit_batch_size]
+                     for start in range(0, len(units), self.unit_batch_size)]
+            if n_workers > 1 and len(tasks) > 1:
+                # spawned (not forked) workers - no inherited database connection
+                with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=_init_glm_worker, initargs=shared) as executor:
+                    results = list(executor.map(_fit_unit_glms, tasks))
+            else:
+                _init_glm_worker(*shared)
+                results = [_fit_unit_glms(task) for task in tasks]
+
+            for u, res in zip(units, (r for batch in results for r in batch)):
+                entries.append({**u, **tracking_key, 'glm_param_set': key['glm_param_set'],
+                                'regressors': regressors, **res})
+
+        self.insert(entries)
+
+
+# ========= HELPER METHODS ======
+
+
+def _get_spike_frames(spike_times, timestamps):
+    """
+    Map the spikes to the nearest tracking frame
+    :param spike_times: (spikes,) spike times, same time reference as the timestamps
+    :param timestamps: (frames,) sorted frame timestamps
+    :return: (spikes,) frame indices, (spikes,) bool - spike within the tracking period (half a frame tolerance)
+    """
+    idx = np.clip(np.searchsorted(timestamps, spike_times), 1, len(timestamps) - 1)
+    idx -= (spike_times - timestamps[idx - 1]) < (timestamps[idx] - spike_times)
+
+    half_frame = np.median(np.diff(timestamps)) / 2
+    in_tracking = (spike_times >= timestamps[0] - half_frame) & (spike_times <= timestamps[-1] + half_frame)
+    return idx, in_tracking
+
+
+def compute_phase_locking(phase, mask, frame, unit_idx, n_units, n_bins, shifts=(), max_batch_size=int(5e7)):
+    """
+    Phase locking of the spikes of all units to the phase of all whiskers
+    The shuffle null is built by circularly shifting the spike frames relative to the whisker phase,
+     evaluated in batches of shifts
+    :param phase: (whiskers x frames) whisking phase (rad), in [-pi, pi]
+    :param mask: (whiskers x frames) bool - frames to include (e.g. whisking)
+    :param frame: (spikes,) tracking frame of each spike, spikes grouped by unit
+    :param unit_idx: (spikes,) sorted unit index of each spike
+    :param n_units: number of units
+    :param n_bins: number of phase histogram bins
+    :param shifts: (shuffles,) circular shifts (in frames) of the shuffle null
+    :param max_batch_size: max number of elements of the gathered (shuffles x spikes x 3 x whiskers) float64
+        array per batch - mask, cos and sin of the phase of each whisker at each shifted spike - batched over
+        both the shuffles and the spikes
+    :return: dict of (whiskers x units) arrays - spike_count, phase_histogram (with trailing phase bin axis),
+        vector_strength, preferred_phase, shuffle_p_value
+    """
+    n_whiskers, n_frames = phase.shape
+    n_pairs = n_whiskers * n_units
+
+    # (frames x 3 x whiskers) table of the mask and unit phase vectors (zeroed outside of the mask),
+    # frame-major so that each spike gathers one contiguous row
+    table = np.stack([mask, np.where(mask, np.cos(phase), 0), np.where(mask, np.sin(phase), 0)])
+    table = np.ascontiguousarray(np.moveaxis(table, -1, 0)).reshape(n_frames, -1)
+
+    # batches of (shuffles x spikes) elements: spikes are chunked too, for spike counts beyond max_batch_size
+    spike_chunk = max(1, min(len(frame), max_batch_size // table.shape[-1]))
+    batch_size = max(1, max_batch_size // (table.shape[-1] * spike_chunk))
+
+    def _resultant(spike_frames):
+        # (... x spikes) -> (whiskers x ... x units) spike count & sum of the phase vectors
+        # spikes are grouped by unit - per unit sums over the contiguous spike segments of each chunk
+        sums = np.zeros(spike_frames.shape[:-1] + (n_units, table.shape[-1]))
+        for chunk_start in range(0, len(unit_idx), spike_chunk):
+            chunk_units = unit_idx[chunk_start:chunk_start + spike_chunk]
+            segments = np.flatnonzero(np.diff(chunk_units, prepend=-1))
+            sums[..., chunk_units[segments], :] += np.add.reduceat(
+                table[spike_frames[..., chunk_start:chunk_start + spike_chunk]], segments, axis=-2)
+        count, re, im = np.moveaxis(sums.reshape(sums.shape[:-1] + (3, n_whiskers)), (-2, -1), (0, 1))
+        return count, re + 1j * im
+
+    count, resultant = _resultant(frame)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vector_strength = np.abs(resultant) / count
+
+    # phase histograms - (whisker, unit, bin) flat index
+    valid = mask[:, frame]
+    phase_bin = np.clip(((phase[:, frame] + np.pi) / (2 * np.pi) * n_bins).astype(int), 0, n_bins - 1)
+    hist_idx = ((np.arange(n_whiskers)[:, None] * n_units + unit_idx) * n_bins + phase_bin)[valid]
+    phase_histogram = np.bincount(hist_idx, minlength=n_pairs * n_bins).reshape(n_whiskers, n_units, n_bins)
+
+    # circular shuffle null - batches of shifts
+    shifts = np.asarray(shifts, dtype=int)
+    exceed_count = np.zeros((n_whiskers, n_units))
+    for start in range(0, len(shifts), batch_size):
+        shifted = (frame + shifts[start:start + batch_size, None]) % n_frames
+        shuffle_count, shuffle_resultant = _resultant(shifted)  # (whiskers x shuffles x units)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            exceed_count += (np.abs(shuffle_resultant) / shuffle_count >= vector_strength[:, None]).sum(axis=1)
+
+    has_spikes = count > 0
+    return {'spike_count': count.astype(int),
+            'phase_histogram': phase_histogram,
+            'vector_strength': np.where(has_spikes, vector_strength, None),
+            'preferred_phase': np.where(has_spikes, np.angle(resultant), None),
+            'shuffle_p_value': np.where(has_spikes & bool(len(shifts)),
+                                        (exceed_count + 1) / (len(shifts) + 1), None)}
+
+
+def _get_kinematics(tracking_key):
+    """
+    Whisker kinematics of a Tracking, as (whiskers x frames) arrays - angle_raw, set_point, amplitude,
+     phase_cos, phase_sin, and touch (any object) if WhiskerObjectDistance is populated
+    """
+    whisker_idx, *values = (tracking.ProcessedWhisker & tracking_key).fetch(
+        'whisker_idx', 'angle_raw', 'set_point', 'amplitude', 'phase', order_by='whisker_idx')
+    angle, set_point, amplitude, phase = (np.vstack([np.asarray(v, dtype=float).ravel() for v in var])
+                                          for var in values)
+    variables = {'angle': angle, 'set_point': set_point, 'amplitude': amplitude,
+                 'phase_cos': np.cos(phase), 'phase_sin': np.sin(phase)}
+
+    touches = tracking.WhiskerObjectDistance & tracking_key
+    if touches:
+        touch = np.zeros(angle.shape)
+        touch_whiskers, onsets, offsets = touches.fetch('whisker_idx', 'touch_onsets', 'touch_offsets')
+        row_idx = np.searchsorted(whisker_idx, touch_whiskers)
+        # +1 at onsets, -1 at offsets, then cumulative sum - count of touched objects per frame
+        edges = np.zeros((len(whisker_idx), angle.shape[1] + 1))
+        for row, on, off in zip(row_idx, onsets, offsets):
+            np.add.at(edges[row], np.asarray(on, dtype=int), 1)
+            np.add.at(edges[row], np.asarray(off, dtype=int), -1)
+        touch = (np.cumsum(edges, axis=-1)[:, :-1] > 0).astype(float)
+        variables['touch'] = touch
+
+    return {'{}_{}'.format(name, w): x[i] for name, x in variables.items() for i, w in enumerate(whisker_idx)}
+
+
+def build_kinematics_design(timestamps, variables, bin_size, lag_edges):
+    """
+    Lagged design matrix of tracking variables resampled to a common time bin
+    Each variable is averaged per bin, z-scored, then averaged over each lag window [lag_edges[i], lag_edges[i+1])
+     relative to the spike bin - all windows at once, from cumulative sums (zero padding beyond the tracking)
+    :param timestamps: (frames,) (s) frame times
+    :param variables: dict of {name: (frames,) values}
+    :param bin_size: (s)
+    :param lag_edges: (windows + 1,) (s) lag window edges - multiples of bin_size
+    :return: bin_edges (bins + 1,), design matrix (bins x regressors) with the intercept first, regressor names
+    """
+    lag_bins = np.round(np.asarray(lag_edges, dtype=float) / bin_size).astype(int)
+    if not np.allclose(lag_bins * bin_size, lag_edges, rtol=0, atol=1e-6 * bin_size):
+        raise ValueError('Lag window edges {} are not multiples of the bin size ({} s)'.format(
+            list(lag_edges), bin_size))
+    if np.any(np.diff(lag_bins) <= 0):
+        raise ValueError('Lag window edges {} are not increasing'.format(list(lag_edges)))
+
+    names = list(variables)
+    values = np.vstack([variables[n] for n in names])
+
+    bin_edges = np.arange(timestamps[0], timestamps[-1] + bin_size, bin_size)
+    n_bins = len(bin_edges) - 1
+
+    # per bin mean of each variable - frames are sorted, bins are contiguous frame ranges
+    frame_bounds = np.searchsorted(timestamps, bin_edges)
+    cum_values = np.pad(np.cumsum(values, axis=-1), ((0, 0), (1, 0)))
+    frame_counts = np.diff(frame_bounds)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        binned = np.diff(cum_values[:, frame_bounds], axis=-1) / frame_counts
+    binned[:, frame_counts == 0] = np.nan
+
+    # z-score, bins without frame set to the mean (0)
+    binned = (binned - np.nanmean(binned, axis=-1, keepdims=True)) / np.maximum(
+        np.nanstd(binned, axis=-1, keepdims=True), np.finfo(float).eps)
+    binned = np.nan_to_num(binned)
+
+    # lag windows - regressor at bin t: mean of the variable over bins [t + lag_start, t + lag_stop)
+    cum_binned = np.pad(np.cumsum(binned, axis=-1), ((0, 0), (1, 0)))
+    bins = np.arange(n_bins)
+    window_idx = np.clip(bins[:, None] + lag_bins[None, :], 0, n_bins)  # (bins x windows + 1)
+    lagged = np.diff(cum_binned[:, window_idx], axis=-1) / np.diff(lag_bins)  # (variables x bins x windows)
+
+    design = np.hstack([np.ones((n_bins, 1)), lagged.transpose(1, 0, 2).reshape(n_bins, -1)])
+    regressors = ['intercept'] + ['{}_{:+g}:{:+g}s'.format(n, round(l0 * bin_size, 6), round(l1 * bin_size, 6))
+                                  for n in names for l0, l1 in zip(lag_bins[:-1], lag_bins[1:])]
+    return bin_edges, design, regressors
+
+
+# ---- process pool workers of UnitKinematicsGlm ----
+
+_glm_worker_data = {}
+
+
+def _init_glm_worker(design, train_mask, gram_eigs, ridge, max_iter, tol):
+    # shared by all the tasks of a worker - sent once per process
+    _glm_worker_data.update(design=design, train_mask=train_mask, gram_eigs=gram_eigs,
+                            ridge=ridge, max_iter=max_iter, tol=tol)
+
+
+def _fit_unit_glms(spike_bins):
+    """
+    Cross-validated Poisson GLM fits of a batch of units, on the shared design matrix
+    :param spike_bins: list of (spikes,) bin index of the spikes of each unit
+    :return: list of dict (one per unit) - coefficients, cv_deviance, cv_null_deviance, cv_deviance_explained
+    """
+    d = _glm_worker_data
+    design, train_mask = d['design'], d['train_mask']
+    n_bins, n_fits = train_mask.shape
+    fold_count = n_fits - 1
+
+    counts = np.vstack([np.bincount(b, minlength=n_bins) for b in spike_bins]).T.astype(float)  # (bins x units)
+
+    coefs = fit_poisson_glm(design, counts, train_mask, d['gram_eigs'], d['ridge'], d['max_iter'], d['tol'])
+
+    # held-out deviance of each fold fit (on its test bins), and of the train mean rate
+    deviance, null_deviance = np.zeros(counts.shape[1]), np.zeros(counts.shape[1])
+    for f in range(fold_count):
+        test = ~train_mask[:, f]
+        y = counts[test]
+        mu = np.exp(np.minimum(design[test] @ coefs[:, :, f], 50))
+        mu0 = np.maximum(counts[train_mask[:, f]].mean(axis=0), np.finfo(float).tiny)
+        deviance += _poisson_deviance(y, mu)
+        null_deviance += _poisson_deviance(y, np.broadcast_to(mu0, y.shape))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        explained = np.where(null_deviance > 0, 1 - deviance / null_deviance, np.nan)
+
+    return [{'coefficients': coefs[:, u, -1], 'cv_deviance': deviance[u], 'cv_null_deviance': null_deviance[u],
+             'cv_deviance_explained': None if np.isnan(explained[u]) else explained[u]}
+            for u in range(counts.shape[1])]
+
+
+def fit_poisson_glm(design, counts, train_mask, gram_eigs, ridge=1., max_iter=100, tol=1e-6, max_refresh=5):
+    """
+    Ridge-penalized Poisson GLM (log link) fits of several units x several train sets at once - the intercept
+     (first regressor) is not penalized
+    1/ start from the train mean rate, with one Newton step of the constant rate model - Hessian
+        mean_rate * X'X + ridge * I, from the eigendecomposition of the Gram matrix X'X of each train set,
+        shared by all units
+    2/ chord Newton iterations: the Hessian X'diag(mu)X + ridge * I (0 for the intercept) of each fit is inverted
+        once and reused over the iterations (two (bins x regressors) matrix products per iteration) - refreshed only when the
+        convergence slows down (iteration not improving the penalized log-likelihood, or not halving the step)
+        The Hessians of all fits of a unit are sums of per-fold blocks, evaluated at the rates of the fit with the
+        most train bins: one full Hessian computation per unit
+    Steps are halved until the penalized log-likelihood improves
+    :param design: (bins x regressors) design matrix X
+    :param counts: (bins x units) spike counts
+    :param train_mask: (bins x fits) bool - train bins of each fit
+    :param gram_eigs: list (fits) of eigendecompositions (eigenvalues, eigenvectors) of X[train]'X[train]
+    :param max_refresh: max number of Hessian re-computations
+    :return: (regressors x units x fits) coefficients
+    """
+    n_bins, n_units = counts.shape
+    n_regressors, n_fits = design.shape[1], train_mask.shape[1]
+    weights = train_mask[:, None, :].astype(float)  # (bins x 1 x fits)
+    y = counts[:, :, None]
+    penalty = np.full(n_regressors, float(ridge))
+    penalty[0] = 0  # intercept
+
+    def _eta(coefs):
+        return np.minimum((design @ coefs.reshape(n_regressors, -1)).reshape(n_bins, n_units, n_fits), 50)
+
+    def _penalized_ll(coefs, eta):
+        return (weights * (y * eta - np.exp(eta))).sum(axis=0) - (penalty[:, None, None] * coefs ** 2).sum(axis=0) / 2
+
+    def _gradient(coefs, eta):
+        residual = (weights * (y - np.exp(eta))).reshape(n_bins, -1)
+        return (design.T @ residual).reshape(coefs.shape) - penalty[:, None, None] * coefs
+
+    def _line_search(coefs, eta, ll, step, active):
+        # halve the steps until the penalized log-likelihood improves - else keep the current coefficients
+        scale = np.ones((n_units, n_fits))
+        for _ in range(20):
+            new_coefs = coefs + scale * step
+            new_eta = _eta(new_coefs)
+            new_ll = _penalized_ll(new_coefs, new_eta)
+            worse = active & (new_ll < ll)
+            if not worse.any():
+                break
+            scale[worse] /= 2
+        improved = active & ~worse
+        return (np.where(improved, new_coefs, coefs), np.where(improved, new_eta, eta),
+                np.where(improved, new_ll, ll), improved, np.abs(scale * step).max(axis=0))
+
+    # bins grouped by train pattern (e.g. cross-validation folds): Hessian blocks computed once per group
+    patterns, bin_group = np.unique(train_mask, axis=0, return_inverse=True)
+    bin_group = bin_group.ravel()
+    reference_fit = np.argmax(train_mask.sum(axis=0))
+
+    def _inverse_hessian(eta):
+        # (units x fits x regressors x regressors) - the chord iterations only need an approximate Hessian:
+        # evaluated at the rates of the reference fit (most train bins), for all fits, as sums of group blocks
+        mu = np.exp(eta[:, :, reference_fit])
+        hessian = np.zeros((n_units, n_fits, n_regressors, n_regressors))
+        for g, pattern in enumerate(patterns):
+            group_design = design[bin_group == g]
+            group_mu = mu[bin_group == g]
+            for u in range(n_units):
+                hessian[u, pattern] += (group_design * group_mu[:, u, None]).T @ group_design
+        return np.linalg.inv(hessian + np.diag(penalty))
+
+    active = np.ones((n_units, n_fits), dtype=bool)
+
+    # 1/ constant rate start - the warm step uses an isotropic ridge (shared eigendecompositions), only as a
+    #  search direction: the line search applies the actual penalty
+    coefs = np.zeros((n_regressors, n_units, n_fits))
+    rate = np.maximum((weights * y).sum(axis=0) / weights.sum(axis=0), 1e-3)  # (units x fits)
+    coefs[0] = np.log(rate)
+    eta = _eta(coefs)
+    ll = _penalized_ll(coefs, eta)
+
+    grad = _gradient(coefs, eta)
+    step = np.empty_like(coefs)
+    for f, (eigvals, eigvecs) in enumerate(gram_eigs):
+        step[:, :, f] = eigvecs @ ((eigvecs.T @ grad[:, :, f]) / (eigvals[:, None] * rate[None, :, f] + ridge))
+    coefs, eta, ll, _, _ = _line_search(coefs, eta, ll, step, active)
+
+    # 2/ chord Newton iterations
+    inv_hessian = _inverse_hessian(eta)
+    refresh_count = 0
+    previous_step_size = np.full((n_units, n_fits), np.inf)
+    for _ in range(max_iter):
+        step = np.einsum('ufrq,quf->ruf', inv_hessian, _gradient(coefs, eta)) * active
+        coefs, eta, ll, improved, step_size = _line_search(coefs, eta, ll, step, active)
+
+        active &= ~(improved & (step_size <= tol))
+        # refresh the Hessian when an active fit stalls or converges slowly (less than halving its step)
+        slow = active & (~improved | (step_size > previous_step_size / 2))
+        if slow.any() and refresh_count < max_refresh:
+            inv_hessian = _inverse_hessian(eta)
+            refresh_count += 1
+        else:
+            active &= improved
+        previous_step_size = step_size
+        if not active.any():
+            break
+
+    return coefs
+
+
+def _poisson_deviance(y, mu):
+    """
+    Poisson deviance, summed over bins (first axis)
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        log_ratio = np.where(y > 0, np.log(y / mu), 0)
+    return 2 * (y * log_ratio - (y - mu)).sum(axis=0)
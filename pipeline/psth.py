@@ -1,5 +1,6 @@
 import logging
 import hashlib
+import pathlib
 
 from functools import partial
 from inspect import getmembers
@@ -7,12 +8,13 @@ from itertools import repeat
 import numpy as np
 import datajoint as dj
 import scipy.stats as sc_stats
+import scipy.signal as sc_signal
 
 from . import (lab, experiment, ephys)
 [lab, experiment, ephys]  # NOQA
 
-from . import get_schema_name, dict_to_hash
-from .util import _get_units_hemisphere
+from . import get_schema_name, dict_to_hash, LRUCache
+from .util import _get_units_hemisphere, _trial_event_cache
 
 schema = dj.schema(get_schema_name('psth'))
 log = logging.getLogger(__name__)
@@ -36,9 +38,66 @@ class TrialCondition(dj.Lookup):
     trial_condition_arg:        longblob        # trial retrieval arguments
     """
 
+    # in-process caches, keyed on trial_condition_hash
+    _func_cache = LRUCache(maxsize=256)  # trial_condition_hash -> trial retrieval function
+    _condition_hashes = LRUCache(maxsize=256)  # trial_condition_name -> trial_condition_hash
+
+    @classmethod
+    def get_trials(cls, trial_condition_name, session_key=None):
+        """
+        Return the trials (a query on experiment.BehaviorTrial) matching this condition.
+        If a `session_key` (or a list of session keys) is given, restrict to those sessions - using the
+        materialized TrialConditionMembership of the sessions where available, rather than the dynamic
+        condition query
+        """
+        if session_key is None:
+            return cls._get_condition_func(trial_condition_name)()
+
+        session_keys = [session_key] if isinstance(session_key, dict) else session_key
+        session_keys = [{k: s[k] for k in ('subject_id', 'session')} for s in session_keys]
+        cond_key = {'trial_condition_name': trial_condition_name}
+
+        materialized = (TrialConditionMembership & cond_key & session_keys).fetch(
+            'subject_id', 'session', as_dict=True)
+        dynamic = [s for s in session_keys if s not in materialized]
+
+        restrictions = []
+        if materialized:
+            restrictions.append(TrialConditionMembership.Trial & cond_key & materialized)
+        if dynamic:
+            restrictions.append(cls._get_condition_func(trial_condition_name)() & dynamic)
+        return experiment.BehaviorTrial & restrictions
+
+    @classmethod
+    def invalidate(cls, session_key):
+        """
+        Drop the materialized membership and the cached trial events of a session, and the cached condition hashes.
+        To be called whenever BehaviorTrial or PhotostimEvent rows are added for that session
+        (note: only the caches of the current process are cleared)
+        """
+        session_key = {k: session_key[k] for k in ('subject_id', 'session')}
+        log.debug('TrialCondition.invalidate(): session: {}'.format(session_key))
+
+        (TrialConditionMembership.Trial & session_key).delete_quick()
+        (TrialConditionMembership & session_key).delete_quick()
+
+        session = (session_key['subject_id'], session_key['session'])
+        _trial_event_cache.invalidate(lambda k: session in k[1])
+        cls._condition_hashes.invalidate()  # conditions may have been re-inserted with a new hash
+
+    @classmethod
+    def _get_condition_hash(cls, trial_condition_name):
+        if trial_condition_name not in cls._condition_hashes:
+            cls._condition_hashes[trial_condition_name] = (
+                    cls & {'trial_condition_name': trial_condition_name}).fetch1('trial_condition_hash')
+        return cls._condition_hashes[trial_condition_name]
+
     @classmethod
-    def get_trials(cls, trial_condition_name):
-        return cls.get_func({'trial_condition_name': trial_condition_name})()
+    def _get_condition_func(cls, trial_condition_name):
+        cond_hash = cls._get_condition_hash(trial_condition_name)
+        if cond_hash not in cls._func_cache:
+            cls._func_cache[cond_hash] = cls.get_func({'trial_condition_name': trial_condition_name})
+        return cls._func_cache[cond_hash]
 
     @classmethod
     def get_cond_name_from_keywords(cls, keywords):
@@ -119,62 +178,174 @@ class TrialCondition(dj.Lookup):
 
 
 @schema
-class UnitPsth(dj.Computed):
+class TrialConditionMembership(dj.Computed):
+    definition = """
+    # Materialized TrialCondition - trials of each session that match the condition
+    -> TrialCondition
+    -> experiment.Session
+    """
+
+    class Trial(dj.Part):
+        definition = """
+        -> master
+        -> experiment.BehaviorTrial
+        """
+
+    @property
+    def key_source(self):
+        """
+        For those conditions that include stim, process those with PhotostimBrainRegion already computed only
+        """
+        sessions = experiment.Session & experiment.BehaviorTrial
+        nostim = sessions * (TrialCondition & 'trial_condition_func = "_get_trials_exclude_stim"')
+        stim = ((sessions & experiment.PhotostimBrainRegion)
+                * (TrialCondition & 'trial_condition_func = "_get_trials_include_stim"'))
+        return nostim.proj() + stim.proj()
+
+    def make(self, key):
+        log.debug('TrialConditionMembership.make(): key: {}'.format(key))
+
+        session_key = {k: key[k] for k in ('subject_id', 'session')}
+        # always resolve from the dynamic condition query here
+        trials = TrialCondition._get_condition_func(key['trial_condition_name'])() & session_key
+
+        self.insert1(key)
+        self.Trial.insert([{**key, **tr} for tr in trials.fetch('KEY')])
+
+
+@schema
+class PsthParamSet(dj.Lookup):
+    definition = """
+    psth_param_set:     varchar(32)
+    ---
+    psth_xmin:          decimal(8, 4)   # (s) start of the psth window
+    psth_xmax:          decimal(8, 4)   # (s) end of the psth window
+    psth_binsize:       decimal(8, 4)   # (s) bin size
+    """
+    contents = [('default', -3, 3, 0.04),
+                ('10ms', -3, 3, 0.01),
+                ('20ms', -3, 3, 0.02),
+                ('100ms', -3, 3, 0.1)]
+
+    # finest resolution - spike counts are binned once at this resolution (UnitPsthCounts)
+    # and the psth of any aligned, coarser parameter set is derived from them
+    base_param_set = '10ms'
+
+    @classmethod
+    def get_binning(cls, psth_param_set='default'):
+        """
+        Return the bin edges and bin size of a psth parameter set
+        """
+        xmin, xmax, bin_size = (cls & {'psth_param_set': psth_param_set}).fetch1(
+            'psth_xmin', 'psth_xmax', 'psth_binsize')
+        xmin, xmax, bin_size = float(xmin), float(xmax), float(bin_size)
+        # same edges as np.arange(xmin, xmax, bin_size), without the floating point drift
+        n_edges = int(np.ceil(np.round((xmax - xmin) / bin_size, 6)))
+        return xmin + bin_size * np.arange(n_edges), bin_size
+
+
+@schema
+class UnitPsthCounts(dj.Computed):
     definition = """
+    # Spike counts summed over the trials of a condition, at the base resolution (PsthParamSet.base_param_set)
     -> TrialCondition
     -> ephys.Unit
     ---
-    unit_psth=NULL: longblob
+    trial_count:            int         # number of trials
+    spike_counts=NULL:      longblob    # (time,) spike counts summed over trials
     """
-    psth_params = {'xmin': -3, 'xmax': 3, 'binsize': 0.04}
 
     @property
     def key_source(self):
         """
+        Populated per (trial_condition, probe insertion): the trial set is resolved once and
+        all units of the insertion are computed and inserted together.
         For those conditions that include stim, process those with PhotostimBrainRegion already computed only
         Only units not of type "all"
         """
-        nostim = (ephys.Unit * (TrialCondition & 'trial_condition_func = "_get_trials_exclude_stim"')
-                  & 'unit_quality != "all"')
-        stim = ((ephys.Unit & (experiment.Session & experiment.PhotostimBrainRegion))
-                * (TrialCondition & 'trial_condition_func = "_get_trials_include_stim"') & 'unit_quality != "all"')
+        units = ephys.Unit & 'unit_quality != "all"'
+        nostim = ((ephys.ProbeInsertion & units)
+                  * (TrialCondition & 'trial_condition_func = "_get_trials_exclude_stim"'))
+        stim = ((ephys.ProbeInsertion & units & (experiment.Session & experiment.PhotostimBrainRegion))
+                * (TrialCondition & 'trial_condition_func = "_get_trials_include_stim"'))
         return nostim.proj() + stim.proj()
 
+    def make(self, key):
+        log.debug('UnitPsthCounts.make(): key: {}'.format(key))
+
+        binning, _ = PsthParamSet.get_binning(PsthParamSet.base_param_set)
+        units, trial_counts, counts = _get_insertion_psth_counts(key, binning)
+
+        self.insert([{**key, **u, 'trial_count': n, 'spike_counts': c if n else None}
+                     for u, n, c in zip(units, trial_counts, counts)])
+
+
+@schema
+class UnitPsth(dj.Computed):
+    definition = """
+    -> TrialCondition
+    -> ephys.Unit
+    -> PsthParamSet
+    ---
+    unit_psth=NULL: longblob
+    """
+
+    @property
+    def key_source(self):
+        """
+        Populated per (trial_condition, probe insertion, psth_param_set), once UnitPsthCounts is computed
+        """
+        return (ephys.ProbeInsertion * TrialCondition & UnitPsthCounts).proj() * PsthParamSet.proj()
+
     def make(self, key):
         log.debug('UnitPsth.make(): key: {}'.format(key))
 
-        # expand TrialCondition to trials,
-        trials = TrialCondition.get_trials(key['trial_condition_name'])
+        binning, bin_size = PsthParamSet.get_binning(key['psth_param_set'])
+        base_binning, _ = PsthParamSet.get_binning(PsthParamSet.base_param_set)
+        n_bins = len(binning) - 1
+
+        cond_key = {k: v for k, v in key.items() if k != 'psth_param_set'}
+        units, trial_counts, spike_counts = (UnitPsthCounts & cond_key).fetch(
+            'KEY', 'trial_count', 'spike_counts', order_by='unit')
 
-        # fetch related spike times
-        q = (ephys.Unit.TrialSpikes & key & trials.proj())
-        spikes = q.fetch('spike_times')
+        rebin = _get_rebin_factor(base_binning, binning)
 
-        if len(spikes) == 0:
-            log.warning('no spikes found for key {} - null psth'.format(key))
-            self.insert1(key)
-            return
+        if rebin is not None:
+            # derive from the base resolution counts - summing neighbouring bins
+            offset, factor = rebin
+            counts = [None if c is None else c[offset:offset + n_bins * factor].reshape(n_bins, factor).sum(axis=1)
+                      for c in spike_counts]
+        else:
+            # not aligned with the base resolution - bin the spikes again
+            log.info('psth_param_set {} is not aligned with {} - binning from spikes'.format(
+                key['psth_param_set'], PsthParamSet.base_param_set))
+            units, trial_counts, counts = _get_insertion_psth_counts(cond_key, binning)
 
-        # compute psth & store
-        unit_psth = self.compute_psth(spikes)
+        unit_psths = [np.array([c / n / bin_size, binning[1:]]) if n else None
+                      for c, n in zip(counts, trial_counts)]
 
-        self.insert1({**key, 'unit_psth': unit_psth})
+        for u, unit_psth in zip(units, unit_psths):
+            if unit_psth is None:
+                log.warning('no spikes found for key {} - null psth'.format({**key, **u}))
+
+        self.insert([{**key, **u, 'unit_psth': unit_psth} for u, unit_psth in zip(units, unit_psths)])
 
     @staticmethod
-    def compute_psth(session_unit_spikes):
+    def compute_psth(session_unit_spikes, psth_param_set='default'):
         spikes = np.concatenate(session_unit_spikes)
 
-        xmin, xmax, bins = UnitPsth.psth_params.values()
-        psth, edges = np.histogram(spikes, bins=np.arange(xmin, xmax, bins))
-        psth = psth / len(session_unit_spikes) / bins
+        binning, bin_size = PsthParamSet.get_binning(psth_param_set)
+        psth, edges = np.histogram(spikes, bins=binning)
+        psth = psth / len(session_unit_spikes) / bin_size
 
         return np.array([psth, edges[1:]])
 
     @classmethod
-    def get_plotting_data(cls, unit_key, condition_key):
+    def get_plotting_data(cls, unit_key, condition_key, psth_param_set='default', decimate=None):
         """
         Retrieve / build data needed for a Unit PSTH Plot based on the given
         unit condition and included / excluded condition (sub-)variables.
+        The raster is read from UnitRaster when available.
         Returns a dictionary of the form:
           {
              'trials': ephys.Unit.TrialSpikes.trials,
@@ -182,50 +353,603 @@ class UnitPsth(dj.Computed):
              'psth': UnitPsth.unit_psth,
              'raster': Spike * Trial raster [np.array, np.array]
           }
+        :param decimate: optional (width_px, height_px) of the plot - the raster is decimated to
+            one spike per pixel (see `decimate_raster`), 'spikes' is then left out
         """
-        # from sys import exit as sys_exit  # NOQA
-        # from code import interact
-        # from collections import ChainMap
-        # interact('unitpsth make', local=dict(ChainMap(locals(), globals())))
-
-        trials = TrialCondition.get_func(condition_key)()
-
-        unit_psth = (UnitPsth & {**condition_key, **unit_key}).fetch1('unit_psth')
+        unit_psth = (UnitPsth & {**condition_key, **unit_key}
+                     & {'psth_param_set': psth_param_set}).fetch1('unit_psth')
         if unit_psth is None:
             raise Exception('No spikes found for this unit and trial-condition')
 
-        spikes, trials = (ephys.Unit.TrialSpikes & trials & unit_key).fetch(
-            'spike_times', 'trial', order_by='trial asc')
+        raster_query = UnitRaster & {**condition_key, **unit_key}
+        if raster_query:
+            trials, times, trial_idx = raster_query.fetch1('raster_trials', 'raster_times', 'raster_trial_idx')
+        else:
+            trials = TrialCondition.get_trials(condition_key['trial_condition_name'], session_key=unit_key)
+            spikes, trials = (ephys.Unit.TrialSpikes & trials & unit_key).fetch(
+                'spike_times', 'trial', order_by='trial asc')
+            times = np.concatenate(spikes).astype(np.float32)
+            trial_idx = np.repeat(np.arange(len(trials)), [len(s) for s in spikes]).astype(np.uint16)
+
+        if decimate is not None:
+            binning, _ = PsthParamSet.get_binning(psth_param_set)
+            times, trial_idx = decimate_raster(times, trial_idx, len(trials), (binning[0], binning[-1]), *decimate)
+            return dict(trials=trials, psth=unit_psth, raster=[times, trials[trial_idx]])
+
+        spikes = np.split(times, np.searchsorted(trial_idx, np.arange(1, len(trials))))
+
+        return dict(trials=trials, spikes=spikes, psth=unit_psth, raster=[times, trials[trial_idx]])
+
+
+@schema
+class UnitRaster(dj.Computed):
+    definition = """
+    # Cached spike raster of a unit for the trials of a condition
+    -> TrialCondition
+    -> ephys.Unit
+    ---
+    raster_trials:          longblob    # (trials,) trial numbers, in raster row order
+    raster_times:           longblob    # (spikes,) float32 - spike times relative to trial-start
+    raster_trial_idx:       longblob    # (spikes,) uint16 - raster row (index into raster_trials) of each spike
+    """
+
+    @property
+    def key_source(self):
+        """
+        Populated per (trial_condition, probe insertion) - same as UnitPsthCounts
+        """
+        return UnitPsthCounts().key_source
+
+    def make(self, key):
+        log.debug('UnitRaster.make(): key: {}'.format(key))
+
+        trials = TrialCondition.get_trials(key['trial_condition_name'], session_key=key)
+
+        insertion_units = ephys.Unit & key & 'unit_quality != "all"'
+        units = insertion_units.fetch('KEY', order_by='unit')
+        unit_idx = {(u['clustering_method'], u['unit']): i for i, u in enumerate(units)}
+
+        # fetch related spike times - one query for all units
+        methods, unit_ids, trial_nums, spikes = (ephys.Unit.TrialSpikes & insertion_units & trials.proj()).fetch(
+            'clustering_method', 'unit', 'trial', 'spike_times')
+
+        row_unit_idx = np.array([unit_idx[u] for u in zip(methods, unit_ids)], dtype=int)
+
+        # group unit-trials by unit, in trial order
+        order = np.lexsort((trial_nums, row_unit_idx))
+        row_unit_idx, trial_nums, spikes = row_unit_idx[order], trial_nums[order], spikes[order]
+        unit_bounds = np.searchsorted(row_unit_idx, np.arange(len(units) + 1))
+
+        spike_counts = np.array([len(s) for s in spikes], dtype=int)
+        spike_bounds = np.concatenate([[0], np.cumsum(spike_counts)])
+        times = (np.concatenate(spikes) if len(spikes) else np.array([])).astype(np.float32)
+
+        entries = []
+        for u, start, stop in zip(units, unit_bounds[:-1], unit_bounds[1:]):
+            entries.append({**key, **u,
+                            'raster_trials': trial_nums[start:stop],
+                            'raster_times': times[spike_bounds[start]:spike_bounds[stop]],
+                            'raster_trial_idx': np.repeat(np.arange(stop - start),
+                                                          spike_counts[start:stop]).astype(np.uint16)})
+
+        self.insert(entries)
+
+
+@schema
+class AlignmentEvent(dj.Lookup):
+    definition = """
+    alignment_event_name:           varchar(32)
+    ---
+    alignment_event_source:         enum('trial_start', 'trial_event', 'action_event', 'photostim_event')
+    alignment_event_type='':        varchar(32)     # trial_event_type / action_event_type - '' if not applicable
+    alignment_event_pick='first':   enum('first', 'last', 'all')  # event(s) to use when a trial has several
+    """
+    contents = [('trial_start', 'trial_start', '', 'first'),
+                ('go', 'trial_event', 'go', 'last'),
+                ('sample', 'trial_event', 'sample', 'last'),
+                ('delay', 'trial_event', 'delay', 'last'),
+                ('left_lick', 'action_event', 'left lick', 'all'),
+                ('right_lick', 'action_event', 'right lick', 'all'),
+                ('first_lick', 'action_event', '', 'first'),
+                ('photostim_onset', 'photostim_event', '', 'first')]
+
+    # event table, event type attribute, event id attribute and event time attribute (from trial-start) per source
+    _event_sources = {
+        'trial_event': (experiment.TrialEvent, 'trial_event_type', 'trial_event_id', 'trial_event_time'),
+        'action_event': (experiment.ActionEvent, 'action_event_type', 'action_event_id', 'action_event_time'),
+        'photostim_event': (experiment.PhotostimEvent, None, 'photostim_event_id', 'photostim_event_time')}
+
+    @classmethod
+    def get_event_times(cls, alignment_event_name, trials):
+        """
+        Return the times of an alignment event for the specified trials, in session time
+        :param alignment_event_name: an AlignmentEvent
+        :param trials: query/keys of experiment.SessionTrial (or BehaviorTrial) - of a single session
+        :return: trial numbers (events,), event times (events,) - sorted by time
+        """
+        source, event_type, pick = (cls & {'alignment_event_name': alignment_event_name}).fetch1(
+            'alignment_event_source', 'alignment_event_type', 'alignment_event_pick')
+
+        if source == 'trial_start':
+            trial, event_time = (experiment.SessionTrial & trials).proj(t='start_time * 1e0').fetch('trial', 't')
+            order = np.argsort(event_time)
+            return trial[order], event_time[order].astype(float)
+
+        event_tbl, type_attr, id_attr, time_attr = cls._event_sources[source]
+        q = experiment.SessionTrial * event_tbl & trials
+        if type_attr and event_type:
+            q = q & {type_attr: event_type}
+
+        # decimals times a double literal returns doubles from MySQL
+        trial, event_id, event_time = q.proj(t='(start_time + {}) * 1e0'.format(time_attr)).fetch(
+            'trial', id_attr, 't')
+        event_time = event_time.astype(float)
+
+        if pick != 'all' and len(trial):
+            # first / last event (by time) of each trial
+            order = np.lexsort((event_time, trial))
+            trial, event_time = trial[order], event_time[order]
+            if pick == 'first':
+                keep = np.flatnonzero(np.r_[True, trial[1:] != trial[:-1]])
+            else:
+                keep = np.flatnonzero(np.r_[trial[1:] != trial[:-1], True])
+            trial, event_time = trial[keep], event_time[keep]
+
+        order = np.argsort(event_time, kind='stable')
+        return trial[order], event_time[order]
+
+
+@schema
+class UnitAlignedPsth(dj.Computed):
+    definition = """
+    # Unit psth aligned to an AlignmentEvent, from the session-level spike times (ephys.Unit.spike_times)
+    -> TrialCondition
+    -> ephys.Unit
+    -> PsthParamSet
+    -> AlignmentEvent
+    ---
+    event_count:        int         # number of alignment events
+    unit_psth=NULL:     longblob    # [psth, time]
+    """
+
+    @property
+    def key_source(self):
+        """
+        Populated per (trial_condition, probe insertion, psth_param_set, alignment_event)
+        - for clusterings of a known offset to the session clock (ephys.Clustering.Offset)
+        """
+        return (UnitPsthCounts().key_source * PsthParamSet.proj() * AlignmentEvent.proj()
+                & ephys.Clustering.Offset)
+
+    def make(self, key):
+        log.debug('UnitAlignedPsth.make(): key: {}'.format(key))
+
+        trials = TrialCondition.get_trials(key['trial_condition_name'], session_key=key)
+        _, event_times = AlignmentEvent.get_event_times(key['alignment_event_name'], trials.proj())
+
+        binning, bin_size = PsthParamSet.get_binning(key['psth_param_set'])
+
+        # spike times shifted by the clustering offset to the session clock (the reference of the event times)
+        units, spike_times = ephys.Unit.get_session_spike_times(ephys.Unit & key & 'unit_quality != "all"')
+
+        aligned, unit_idx, _ = align_spikes(spike_times, event_times, (binning[0], binning[-1]))
+        counts = _bin_spikes(aligned, unit_idx, len(units), binning)
+
+        n_events = len(event_times)
+        if not n_events:
+            log.warning('no alignment event found for key {} - null psth'.format(key))
+
+        self.insert([{**key, **u, 'event_count': n_events,
+                      'unit_psth': np.array([c / n_events / bin_size, binning[1:]]) if n_events else None}
+                     for u, c in zip(units, counts)])
+
+
+@schema
+class PopulationPsth(dj.Computed):
+    definition = """
+    # Units x conditions x time tensor of the UnitPsth of one clustering of a probe insertion
+    -> ephys.Clustering
+    -> PsthParamSet
+    ---
+    unit_count:         int
+    condition_count:    int
+    psth_units:         longblob    # (units,) unit - index of the 1st tensor axis
+    psth_conditions:    longblob    # (conditions,) trial_condition_name - index of the 2nd tensor axis
+    psth_time:          longblob    # (time,) time of the psth bins - 3rd tensor axis
+    psth_tensor:        longblob    # (units x conditions x time) float32 firing rates - NaN where no psth
+    """
+
+    # NOTE: built from the UnitPsth present at populate time - delete and re-populate after adding conditions
+    key_source = ephys.Clustering * PsthParamSet.proj() & UnitPsth
+
+    def make(self, key):
+        log.debug('PopulationPsth.make(): key: {}'.format(key))
+
+        # one bulk fetch for all units & conditions
+        units, conds, unit_psths = (UnitPsth & key).fetch('unit', 'trial_condition_name', 'unit_psth')
+
+        psth_units, unit_idx = np.unique(units, return_inverse=True)
+        psth_conditions, cond_idx = np.unique(conds, return_inverse=True)
+
+        binning, _ = PsthParamSet.get_binning(key['psth_param_set'])
+        tensor = np.full((len(psth_units), len(psth_conditions), len(binning) - 1), np.nan, dtype=np.float32)
+
+        has_psth = np.array([p is not None for p in unit_psths], dtype=bool)
+        if has_psth.any():
+            tensor[unit_idx[has_psth], cond_idx[has_psth]] = np.vstack([p[0] for p in unit_psths[has_psth]])
+
+        self.insert1({**key, 'unit_count': len(psth_units), 'condition_count': len(psth_conditions),
+                      'psth_units': psth_units, 'psth_conditions': psth_conditions,
+                      'psth_time': binning[1:], 'psth_tensor': tensor})
+
+
+@schema
+class ResponseTestParamSet(dj.Lookup):
+    definition = """
+    response_test_param_set:    varchar(32)
+    ---
+    baseline_start:             decimal(8, 4)   # (s) baseline window start, relative to trial-start
+    baseline_stop:              decimal(8, 4)   # (s) baseline window stop
+    response_start:             decimal(8, 4)   # (s) response window start, relative to trial-start
+    response_stop:              decimal(8, 4)   # (s) response window stop
+    resample_count:             int             # number of bootstrap resamples and of permutations
+    random_seed:                int             # seed of the resampling
+    ci_level:                   decimal(4, 3)   # confidence level of the bootstrap CI (e.g. 0.95)
+    """
+    contents = [('default', -1, 0, 0, 1, 10000, 0, 0.95)]
+
+
+@schema
+class UnitResponse(dj.Computed):
+    definition = """
+    # Baseline vs. response firing rate test of a unit, for the trials of a condition
+    -> TrialCondition
+    -> ephys.Unit
+    -> ResponseTestParamSet
+    ---
+    trial_count:            int
+    baseline_rate=NULL:     float   # (Hz) mean baseline firing rate
+    response_rate=NULL:     float   # (Hz) mean response firing rate
+    effect_size=NULL:       float   # (Hz) mean per-trial (response - baseline) firing rate
+    p_value=NULL:           float   # two-sided permutation (sign-flip) p-value of the effect size
+    ci_low=NULL:            float   # (Hz) bootstrap confidence interval of the effect size - low
+    ci_high=NULL:           float   # (Hz) bootstrap confidence interval of the effect size - high
+    """
+
+    @property
+    def key_source(self):
+        """
+        Populated per (trial_condition, probe insertion, response_test_param_set) - all units fetched and tested at once
+        (keys are spread over spawned processes with shell.process_responses - "process-responses" action)
+        """
+        return UnitPsthCounts().key_source * ResponseTestParamSet.proj()
+
+    def make(self, key):
+        log.debug('UnitResponse.make(): key: {}'.format(key))
+
+        params = (ResponseTestParamSet & key).fetch1()
+        baseline = (float(params['baseline_start']), float(params['baseline_stop']))
+        response = (float(params['response_start']), float(params['response_stop']))
+
+        trials = TrialCondition.get_trials(key['trial_condition_name'], session_key=key)
+
+        insertion_units = ephys.Unit & key & 'unit_quality != "all"'
+        units = insertion_units.fetch('KEY', order_by='unit')
+        unit_idx = {(u['clustering_method'], u['unit']): i for i, u in enumerate(units)}
+
+        # fetch related spike times - one query for all units
+        methods, unit_ids, spikes = (ephys.Unit.TrialSpikes & insertion_units & trials.proj()).fetch(
+            'clustering_method', 'unit', 'spike_times')
+        row_unit_idx = np.array([unit_idx[u] for u in zip(methods, unit_ids)], dtype=int)
 
-        raster = [np.concatenate(spikes),
-                  np.concatenate([[t] * len(s)
-                                  for s, t in zip(spikes, trials)])]
+        # per unit-trial baseline and response firing rates
+        spike_counts = np.array([len(s) for s in spikes], dtype=int)
+        spike_row = np.repeat(np.arange(len(spikes)), spike_counts)
+        spikes = np.concatenate(spikes) if len(spikes) else np.array([])
+        baseline_rates = _bin_spikes(spikes, spike_row, len(spike_counts), baseline)[:, 0] / np.diff(baseline)
+        response_rates = _bin_spikes(spikes, spike_row, len(spike_counts), response)[:, 0] / np.diff(response)
 
-        return dict(trials=trials, spikes=spikes, psth=unit_psth, raster=raster)
+        order = np.argsort(row_unit_idx, kind='stable')
+        bounds = np.searchsorted(row_unit_idx[order], np.arange(len(units) + 1))
+        unit_rows = [order[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
 
+        seeds = np.random.SeedSequence(params['random_seed']).spawn(len(units))
+        tasks = [(response_rates[rows] - baseline_rates[rows], params['resample_count'],
+                  seed, float(params['ci_level'])) for rows, seed in zip(unit_rows, seeds)]
 
-def compute_unit_psth(unit_key, trial_keys, per_trial=False):
+        # each test is vectorized over its resamples - keys, not units, are run in parallel (shell.process_responses)
+        results = [_bootstrap_response_test(task) for task in tasks]
+
+        entries = []
+        for u, rows, res in zip(units, unit_rows, results):
+            entry = {**key, **u, 'trial_count': len(rows)}
+            if len(rows):
+                entry.update(baseline_rate=baseline_rates[rows].mean(),
+                             response_rate=response_rates[rows].mean(), **res)
+            entries.append(entry)
+
+        self.insert(entries)
+
+
+def decimate_raster(times, trial_idx, n_trials, time_range, width_px=1000, height_px=None):
+    """
+    Pixel-aware raster decimation: keep a single spike per occupied (time pixel, trial row) cell,
+    the rendered raster is then identical at the given plot size
+    :param times: (spikes,) spike times
+    :param trial_idx: (spikes,) raster row of each spike
+    :param n_trials: number of raster rows
+    :param time_range: (t0, t1) plotted time range - spikes outside are dropped
+    :param width_px: plot width in pixels
+    :param height_px: plot height in pixels (default: one pixel per trial)
+    :return: times, trial_idx of the kept spikes
+    """
+    height_px = n_trials if height_px is None else min(height_px, n_trials)
+    t0, t1 = time_range
+
+    in_range = (times >= t0) & (times <= t1)
+    times, trial_idx = times[in_range], trial_idx[in_range]
+
+    x = np.minimum(((times - t0) / (t1 - t0) * width_px).astype(int), width_px - 1)
+    y = trial_idx.astype(int) * height_px // max(n_trials, 1)
+
+    _, keep = np.unique(y * width_px + x, return_index=True)
+    keep.sort()
+
+    return times[keep], trial_idx[keep]
+
+
+def export_population_tensor(population_keys, filepath):
+    """
+    Write the PopulationPsth tensors of several insertions/sessions into a single memory-mapped .npy,
+    for out-of-core analysis - units are stacked along the 1st axis, conditions are aligned by name.
+    The tensors are fetched and written one at a time.
+    The index vectors (session/unit of each row, conditions, time) are saved along in "<filepath>_index.npz"
+    :param population_keys: restriction on PopulationPsth (a single psth_param_set)
+    :param filepath: path of the .npy file to write
+    :return: the exported tensor, memory-mapped read-only
+    """
+    filepath = pathlib.Path(filepath).with_suffix('.npy')
+    q = PopulationPsth & population_keys
+
+    param_sets = dj.U('psth_param_set') & q
+    if len(param_sets) != 1:
+        raise ValueError('Exporting requires a single psth_param_set - found {}'.format(len(param_sets)))
+
+    keys, unit_ids, conds, times = q.fetch('KEY', 'psth_units', 'psth_conditions', 'psth_time')
+    if not keys:
+        raise ValueError('No PopulationPsth found for {}'.format(population_keys))
+
+    conditions = np.unique(np.concatenate(conds))
+    unit_counts = np.array([len(u) for u in unit_ids])
+    row_offsets = np.concatenate([[0], np.cumsum(unit_counts)])
+
+    tensor = np.lib.format.open_memmap(filepath, mode='w+', dtype=np.float32,
+                                       shape=(row_offsets[-1], len(conditions), len(times[0])))
+    tensor[:] = np.nan
+    for key, cond, start, stop in zip(keys, conds, row_offsets[:-1], row_offsets[1:]):
+        tensor[start:stop][:, np.searchsorted(conditions, cond)] = (PopulationPsth & key).fetch1('psth_tensor')
+    tensor.flush()
+    del tensor
+
+    index = {attr: np.repeat([k[attr] for k in keys], unit_counts)
+             for attr in ('subject_id', 'session', 'insertion_number', 'clustering_method')}
+    np.savez(filepath.with_name(filepath.stem + '_index.npz'),
+             unit=np.concatenate(unit_ids), condition=conditions, time=times[0], **index)
+
+    return np.load(filepath, mmap_mode='r')
+
+
+def compute_unit_psth(unit_key, trial_keys, per_trial=False, smoothing=None, smoothing_width=0.05,
+                      psth_param_set='default'):
     """
     Compute unit-level psth for the specified unit and trial-set - return (time,)
     If per_trial == True, compute trial-level psth - return ((trial x time), time_vec)
     :param unit_key: key of a single unit to compute the PSTH for
     :param trial_keys: list of all the trial keys to compute the PSTH over
+    :param smoothing: optional smoothing kernel applied to the psth - 'gaussian' or 'causal' (see `smooth_psth`)
+    :param smoothing_width: (s) width of the smoothing kernel
+    :param psth_param_set: PsthParamSet defining the psth window and bin size
     """
     q = (ephys.Unit.TrialSpikes & unit_key & trial_keys)
     if not q:
         return None
 
-    xmin, xmax, bin_size = UnitPsth.psth_params.values()
-    binning = np.arange(xmin, xmax, bin_size)
+    binning, bin_size = PsthParamSet.get_binning(psth_param_set)
 
     spikes = q.fetch('spike_times')
 
     if per_trial:
-        trial_psth = np.vstack(np.histogram(spike, bins=binning)[0] / bin_size for spike in spikes)
-        return trial_psth, binning[1:]
+        psth = bin_trial_spikes(spikes, binning) / bin_size
     else:
-        spikes = np.concatenate(spikes)
-        psth, edges = np.histogram(spikes, bins=binning)
+        psth, edges = np.histogram(np.concatenate(spikes), bins=binning)
         psth = psth / len(q) / bin_size
-        return psth, edges[1:]
 
+    if smoothing is not None:
+        psth = smooth_psth(psth, bin_size, kernel=smoothing, width=smoothing_width)
+
+    return psth, binning[1:]
+
+
+def bin_trial_spikes(trial_spikes, edges):
+    """
+    Bin per-trial spike times into a (trial x time) count matrix
+    All trials are concatenated and binned at once, on a combined (trial, bin) index
+    :param trial_spikes: list/array of per-trial spike times
+    :param edges: bin edges
+    :return: (trial x time) spike counts
+    """
+    spike_counts = np.array([len(s) for s in trial_spikes], dtype=int)
+    spikes = np.concatenate(trial_spikes) if len(trial_spikes) else np.array([])
+    trial_idx = np.repeat(np.arange(len(trial_spikes)), spike_counts)
+    return _bin_spikes(spikes, trial_idx, len(trial_spikes), edges)
+
+
+def smooth_psth(psth, bin_size, kernel='gaussian', width=0.05):
+    """
+    Smooth psth(s) along the time (last) axis by FFT convolution - all rows (e.g. trials) at once
+    :param psth: (time,) or (... x time) array
+    :param bin_size: (s) bin size of the psth
+    :param kernel: 'gaussian' - centered gaussian of standard deviation `width`
+                   'causal' - half-exponential of time constant `width`, only past bins contribute
+    :param width: (s) width of the kernel
+    """
+    psth = np.asarray(psth, dtype=float)
+    n_bins = psth.shape[-1]
+    width_bins = max(width / bin_size, 1e-6)
+
+    if kernel == 'gaussian':
+        half = int(np.ceil(4 * width_bins))
+        x = np.arange(-half, half + 1)
+        k = np.exp(-0.5 * (x / width_bins) ** 2)
+    elif kernel == 'causal':
+        x = np.arange(int(np.ceil(5 * width_bins)) + 1)
+        k = np.exp(-x / width_bins)
+    else:
+        raise ValueError('Unknown smoothing kernel: {}'.format(kernel))
+
+    k = (k / k.sum()).reshape((1,) * (psth.ndim - 1) + (-1,))
+
+    if kernel == 'gaussian':
+        return sc_signal.fftconvolve(psth, k, mode='same', axes=-1)
+    else:
+        return sc_signal.fftconvolve(psth, k, mode='full', axes=-1)[..., :n_bins]
+
+
+def align_spikes(unit_spike_times, event_times, window):
+    """
+    Event-aligned spikes for many units and events at once
+    The spikes within `window` of every (unit, event) pair are located with a single searchsorted
+    over all units' spike trains, and gathered into a ragged (flat) output
+    :param unit_spike_times: list of session-level spike times arrays, one per unit
+    :param event_times: (events,) event times, on the same clock as the spikes
+    :param window: (t0, t1) window around each event (s)
+    :return: aligned (spikes,) - spike times relative to their event, sorted by unit then event then time
+             unit_idx (spikes,) - unit (index into unit_spike_times) of each aligned spike
+             event_idx (spikes,) - event (index into event_times) of each aligned spike
+    """
+    t0, t1 = window
+    event_times = np.asarray(event_times, dtype=float).ravel()
+    n_units, n_events = len(unit_spike_times), len(event_times)
+
+    unit_spikes = [np.sort(np.asarray(s, dtype=float).ravel()) for s in unit_spike_times]
+    spikes = np.concatenate(unit_spikes) if n_units else np.array([])
+    spike_unit = np.repeat(np.arange(n_units), [len(s) for s in unit_spikes])
+
+    if not len(spikes) or not n_events:
+        return np.array([]), np.array([], dtype=int), np.array([], dtype=int)
+
+    # search all units at once on a (unit, time) key - each unit's train offset by more than the full time span
+    t_min = min(spikes.min(), event_times.min() + t0)
+    span = max(spikes.max(), event_times.max() + t1) - t_min + 1
+    spike_keys = spike_unit * span + (spikes - t_min)
+
+    unit_offsets = (np.arange(n_units) * span)[:, None]
+    starts = np.searchsorted(spike_keys, unit_offsets + (event_times + t0 - t_min), side='left')
+    stops = np.searchsorted(spike_keys, unit_offsets + (event_times + t1 - t_min), side='right')
+
+    # gather the ragged (unit x event) windows
+    lengths = (stops - starts).ravel()
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    spike_idx = np.repeat(starts.ravel(), lengths) + within
+
+    pair_idx = np.repeat(np.arange(n_units * n_events), lengths)
+    unit_idx, event_idx = np.divmod(pair_idx, n_events)
+
+    return spikes[spike_idx] - event_times[event_idx], unit_idx, event_idx
+
+
+def _bootstrap_response_test(args):
+    """
+    Bootstrap / permutation test of the per-trial (response - baseline) firing rate differences of one unit
+    Resamples are drawn as index (bootstrap) and sign-flip (permutation) matrices, in blocks to bound memory
+    :param args: (differences (trials,), resample_count, seed, ci_level)
+    :return: dict of effect_size, p_value, ci_low, ci_high - empty if no trial
+    """
+    diffs, resample_count, seed, ci_level = args
+    n_trials = len(diffs)
+    if not n_trials:
+        return {}
+
+    rng = np.random.default_rng(seed)
+    effect_size = diffs.mean()
+    block_size = max(1, int(2e6 // n_trials))
+
+    boot_means, null_means = [], []
+    for start in range(0, resample_count, block_size):
+        n = min(block_size, resample_count - start)
+        boot_means.append(diffs[rng.integers(0, n_trials, size=(n, n_trials))].mean(axis=1))
+        signs = rng.integers(0, 2, size=(n, n_trials), dtype=np.int8) * 2 - 1
+        null_means.append((signs * diffs).mean(axis=1))
+    boot_means, null_means = np.concatenate(boot_means), np.concatenate(null_means)
+
+    p_value = (1 + np.sum(np.abs(null_means) >= np.abs(effect_size))) / (resample_count + 1)
+    ci_low, ci_high = np.percentile(boot_means, [50 * (1 - ci_level), 50 * (1 + ci_level)])
+
+    return {'effect_size': effect_size, 'p_value': p_value, 'ci_low': ci_low, 'ci_high': ci_high}
+
+
+def _get_insertion_psth_counts(key, edges):
+    """
+    Spike counts of all units of a probe insertion for a trial condition, summed over trials
+    The condition's trials are resolved once and all units' trial spikes are fetched in one query
+    :param key: trial_condition_name and probe insertion key
+    :param edges: bin edges
+    :return: units (list of keys), trial_counts (units,), counts (units x time)
+    """
+    # expand TrialCondition to trials - once for all units of this insertion
+    trials = TrialCondition.get_trials(key['trial_condition_name'], session_key=key)
+
+    insertion_units = ephys.Unit & key & 'unit_quality != "all"'
+    units = insertion_units.fetch('KEY', order_by='unit')
+    unit_idx = {(u['clustering_method'], u['unit']): i for i, u in enumerate(units)}
+
+    # fetch related spike times - one query for all units
+    methods, unit_ids, spikes = (ephys.Unit.TrialSpikes & insertion_units & trials.proj()).fetch(
+        'clustering_method', 'unit', 'spike_times')
+
+    trial_unit_idx = np.array([unit_idx[u] for u in zip(methods, unit_ids)], dtype=int)
+    trial_counts = np.bincount(trial_unit_idx, minlength=len(units))
+
+    spike_counts = np.array([len(s) for s in spikes], dtype=int)
+    spikes = np.concatenate(spikes) if len(spikes) else np.array([])
+    counts = _bin_spikes(spikes, np.repeat(trial_unit_idx, spike_counts), len(units), edges)
+
+    return units, trial_counts, counts
+
+
+def _get_rebin_factor(base_edges, edges):
+    """
+    Check whether the bins defined by `edges` can be obtained by summing neighbouring bins of `base_edges`
+    :return: (offset, factor) - i.e. bin i spans base bins [offset + i * factor, offset + (i + 1) * factor)
+             None if not derivable
+    """
+    base_size, size = base_edges[1] - base_edges[0], edges[1] - edges[0]
+    factor, offset = size / base_size, (edges[0] - base_edges[0]) / base_size
+    if not (np.isclose(factor, round(factor)) and np.isclose(offset, round(offset))):
+        return None
+    factor, offset = int(round(factor)), int(round(offset))
+    if factor < 1 or offset < 0 or offset + (len(edges) - 1) * factor > len(base_edges) - 1:
+        return None
+    return offset, factor
+
+
+def _bin_spikes(spike_times, row_idx, n_rows, edges):
+    """
+    Bin spike times into a (n_rows x n_bins) count matrix in a single pass,
+    equivalent to one `np.histogram(spike_times[row_idx == r], bins=edges)` per row
+    :param spike_times: 1D array of spike times
+    :param row_idx: 1D array (same length as spike_times) - row (e.g. unit or trial) of each spike
+    :param n_rows: number of rows
+    :param edges: monotonically increasing bin edges
+    """
+    spike_times = np.asarray(spike_times, dtype=float).ravel()
+    row_idx = np.asarray(row_idx, dtype=int).ravel()
+    n_bins = len(edges) - 1
+
+    # same convention as np.histogram: half-open bins, the last one includes its right edge
+    bin_idx = np.searchsorted(edges, spike_times, side='right') - 1
+    bin_idx[spike_times == edges[-1]] = n_bins - 1
+    valid = (bin_idx >= 0) & (bin_idx < n_bins)
+
+    counts = np.bincount(row_idx[valid] * n_bins + bin_idx[valid], minlength=n_rows * n_bins)
+    return counts.reshape(n_rows, n_bins)
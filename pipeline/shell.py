@@ -5,6 +5,7 @@ from code import interact
 from datetime import datetime
 from textwrap import dedent
 import time
+import multiprocessing
 import numpy as np
 import pandas as pd
 import re
@@ -12,9 +13,10 @@ import datajoint as dj
 from pymysql.err import OperationalError
 
 
-from pipeline import (lab, experiment, tracking, ephys, psth, ccf, histology, get_schema_name)
+from pipeline import (lab, experiment, tracking, ephys, psth, ccf, histology, orofacial_analysis,
+                      get_schema_name)
 
-pipeline_modules = [lab, ccf, experiment, ephys, histology, tracking, psth]
+pipeline_modules = [lab, ccf, experiment, ephys, histology, tracking, psth, orofacial_analysis]
 
 log = logging.getLogger(__name__)
 
@@ -74,6 +76,7 @@ def logsetup(*args):
     logging.getLogger('pipeline').setLevel(level)
     logging.getLogger('pipeline.psth').setLevel(level)
     logging.getLogger('pipeline.ccf').setLevel(level)
+    logging.getLogger('pipeline.orofacial_analysis').setLevel(level)
     logging.getLogger('pipeline.ingest.session_ingest').setLevel(level)
     logging.getLogger('pipeline.ingest.behavior_ingest').setLevel(level)
     logging.getLogger('pipeline.ingest.tracking_ingest').setLevel(level)
@@ -98,10 +101,42 @@ def ingest_all(subject_id):
     ephys_ingest.EphysIngestion.populate({'subject_id': subject_id}, **populate_settings)
 
 
+def process_tracking(n_workers=None, *args):
+    """
+    Populate ProcessedWhisker (angle cleanup and processing) - sessions are spread over `n_workers` processes
+    """
+    n_workers = int(n_workers) if n_workers else os.cpu_count()
+
+    print('=========== WHISKER PROCESSING ===========')
+    # each worker opens its own database connection and reserves its own jobs
+    with multiprocessing.get_context('spawn').Pool(n_workers) as pool:
+        pool.map(_populate_worker, [('tracking', 'ProcessedWhisker')] * n_workers)
+
+
+def process_responses(n_workers=None, *args):
+    """
+    Populate UnitResponse (bootstrap response tests) - (condition, insertion) keys are spread over `n_workers` processes
+    """
+    n_workers = int(n_workers) if n_workers else os.cpu_count()
+
+    print('=========== UNIT RESPONSE TESTS ===========')
+    # each worker opens its own database connection and reserves its own jobs
+    with multiprocessing.get_context('spawn').Pool(n_workers) as pool:
+        pool.map(_populate_worker, [('psth', 'UnitResponse')] * n_workers)
+
+
+def _populate_worker(table):
+    module_name, table_name = table
+    module = dict((m.__name__.split('.')[-1], m) for m in pipeline_modules)[module_name]
+    getattr(module, table_name).populate(reserve_jobs=True, suppress_errors=True, display_progress=False)
+
+
 # ==== Action Mapper - for interactive shell ====
 
 actions = {
     'ingest-all': (ingest_all, 'run auto ingest job (load all types)'),
+    'process-tracking': (process_tracking, 'run whisker processing jobs, in parallel across sessions'),
+    'process-responses': (process_responses, 'run unit response test jobs, in parallel across insertions'),
     'shell': (shell, 'interactive shell')
 }
 
@@ -1,5 +1,12 @@
+import logging
+import warnings
 import datajoint as dj
 import numpy as np
+import scipy.signal as sc_signal
+import scipy.fft as sc_fft
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import ndimage
+from scipy.interpolate import CubicSpline
 
 from . import experiment, lab
 from . import get_schema_name
@@ -7,6 +14,10 @@ from . import get_schema_name
 schema = dj.schema(get_schema_name('tracking'))
 [experiment]  # NOQA flake8
 
+log = logging.getLogger(__name__)
+
+_unsynced_sessions = set()  # (subject_id, session) already warned of the missing clock synchronization
+
 
 @schema
 class TrackingDevice(dj.Lookup):
@@ -92,6 +103,61 @@ class Tracking(dj.Imported):
                 'WhiskerTracking': Tracking.WhiskerTracking}
 
 
+@schema
+class TrackingSync(dj.Imported):
+    definition = """
+    # Piecewise-linear mapping of the tracking device clock to the session (ephys) clock, fitted on shared TTL pulses
+    -> Tracking
+    ---
+    pulse_count:        int         # number of TTL pulses matched between the device and the session streams
+    device_knots:       longblob    # (s) knots of the piecewise-linear mapping - device clock
+    session_knots:      longblob    # (s) knots of the piecewise-linear mapping - session clock
+    residual_rms:       float       # (s) rms residual of the matched pulses
+    """
+
+    match_tolerance = 0.05  # (s) max distance between matched pulses
+    knot_interval = 60  # (s) interval between the knots of the drift model
+    min_match_fraction = 0.9  # min fraction of the pulses of the shorter stream matched - the fit fails below
+    max_residual_rms = 0.01  # (s) max rms residual of the matched pulses - the fit fails above
+
+    @classmethod
+    def fit(cls, device_pulses, session_pulses, offset=None):
+        """
+        Fit the clock mapping from the TTL pulse times of both streams (missing / extra pulses are allowed)
+        :param offset: (s) approximate session - device clock offset - required for periodic pulse trains
+        :return: dict of the TrackingSync secondary attributes
+        :raises ValueError: if the pulses cannot be matched unambiguously, or the fit is poor
+        """
+        return fit_clock_sync(device_pulses, session_pulses, cls.match_tolerance, cls.knot_interval,
+                              offset=offset, min_match_fraction=cls.min_match_fraction,
+                              max_residual_rms=cls.max_residual_rms)
+
+    @staticmethod
+    def get_session_time(tracking_key, device_times):
+        """
+        Convert times of the device clock of a Tracking to the session clock (vectorized, any array shape)
+        Times are returned unchanged for a Tracking without TrackingSync (clocks assumed synchronized)
+         - with a warning, once per session
+        """
+        sync = TrackingSync & tracking_key
+        if not sync:
+            session = (tracking_key.get('subject_id'), tracking_key.get('session'))
+            if session not in _unsynced_sessions:
+                _unsynced_sessions.add(session)
+                log.warning('No TrackingSync for subject {} session {} - tracking clock assumed synchronized'
+                            ' to the session clock'.format(*session))
+            return np.asarray(device_times, dtype=float)
+        device_knots, session_knots = sync.fetch1('device_knots', 'session_knots')
+        return sync_times(device_times, device_knots, session_knots)
+
+    @classmethod
+    def get_timestamps(cls, tracking_key):
+        """
+        Tracking.tracking_timestamps of a Tracking, in the session clock
+        """
+        return cls.get_session_time(tracking_key, (Tracking & tracking_key).fetch1('tracking_timestamps').ravel())
+
+
 @schema
 class TrackedWhisker(dj.Manual):
     definition = """
@@ -118,6 +184,10 @@ class WhiskerProcessingParams(dj.Lookup):
     phase_passband: float  # (hz)  passband edge frequencies for 2nd order Butterworth filter applied before Hilbert transform 
     phase_stopband: float  # (hz)  stopband edge frequencies for 2nd order Butterworth filter applied before Hilbert transform 
     """
+    # default: set point below 4 Hz, angle in the 4 - 30 Hz whisking band, phase from the 6 - 30 Hz band (the lower
+    #  edge above the set point band, so that slow set point changes do not produce phase cycles)
+    # parameter sets of data processed offline are inserted by their loader (see tracking_ingest)
+    contents = [('default', 4, 4, 30, 6, 30)]
 
 
 @schema
@@ -128,7 +198,7 @@ class ProcessedWhisker(dj.Computed):
      at least 3dB and stopband attenuation of at least 20dB, so that order N and natural frequency Wn are
       [N,Wn] = buttord( Wp, Ws, 3, 20);
 
-    VP: for documentation, below are the three pre-processing steps performed in Matlab to obtain Angle_raw values (these steps should stay offline, at least for now). See also WhiskerAngleSmoothFill.m
+    VP: for documentation, below are the three pre-processing steps performed in Matlab to obtain Angle_raw values. See also WhiskerAngleSmoothFill.m
     1/ find and replace outliers
         thetas = filloutliers(thetas,'spline','movmedian',20)';
     2/ smooth values
@@ -136,6 +206,7 @@ class ProcessedWhisker(dj.Computed):
     3/ fill missing / NaNs values (if any)
         fillDim=find(size(thetas(whiskerNum,:))==max(size(thetas(whiskerNum,:))));
         thetas(whiskerNum,:)=fillmissing(thetas(whiskerNum,:),'spline',fillDim,'EndValues','nearest');
+    These steps are ported in `clean_whisker_angles`, applied in `make` to the tracked angle to obtain Angle_raw
     """
 
     definition = """
@@ -152,9 +223,182 @@ class ProcessedWhisker(dj.Computed):
     phase: longblob
     """
 
+    # processed per Tracking: all whiskers are filtered together, as one (whiskers x frames) array
+    key_source = Tracking & Tracking.WhiskerTracking
+
+    default_param_set = 'default'
+
+    def make(self, key):
+        params = (WhiskerProcessingParams & {'param_set': self.default_param_set}).fetch1()
+
+        timestamps = (Tracking & key).fetch1('tracking_timestamps')
+        fs = 1 / np.median(np.diff(timestamps))
+
+        whisker_keys, angles = (Tracking.WhiskerTracking & key).fetch('KEY', 'angle', order_by='whisker_idx')
+        angles = np.vstack([np.asarray(a, dtype=float).ravel() for a in angles])
+
+        processed = process_whisker_angles(clean_whisker_angles(angles), fs, params)
+
+        self.insert([{**whisker_key, 'param_set': params['param_set'], 'angle': angles[w],
+                      **{k: v[w] for k, v in processed.items()}}
+                     for w, whisker_key in enumerate(whisker_keys)])
+
+
+@schema
+class WhiskingBout(dj.Computed):
+    definition = """
+    # Whisking bouts of a processed whisker - hysteresis thresholding of the whisking amplitude
+    -> ProcessedWhisker
+    ---
+    bout_onsets:        longblob    # (bouts,) frame index of the onset of each bout
+    bout_offsets:       longblob    # (bouts,) frame index of the offset of each bout (exclusive)
+    bout_onset_times:   longblob    # (s) session clock - (bouts,) onset time of each bout
+    bout_offset_times:  longblob    # (s) session clock - (bouts,) offset time of each bout (exclusive)
+    """
+
+    high_threshold = 5  # (deg) amplitude above which whisking starts
+    low_threshold = 2.5  # (deg) amplitude below which whisking stops
+    min_gap = 0.1  # (s) bouts separated by shorter gaps are merged
+    min_duration = 0.2  # (s) shorter bouts (after merging) are discarded
+
+    # computed per Tracking: all whiskers at once
+    key_source = Tracking & ProcessedWhisker
+
+    def make(self, key):
+        timestamps = TrackingSync.get_timestamps(key)
+        frame_period = np.median(np.diff(timestamps))
+
+        whisker_keys, amplitudes = (ProcessedWhisker & key).fetch('KEY', 'amplitude', order_by='whisker_idx')
+        amplitude = np.vstack([np.asarray(a, dtype=float).ravel() for a in amplitudes])
+
+        row_idx, onsets, offsets = get_bouts(amplitude, self.high_threshold, self.low_threshold,
+                                             int(round(self.min_gap / frame_period)),
+                                             int(round(self.min_duration / frame_period)))
+        bounds = np.searchsorted(row_idx, np.arange(len(whisker_keys) + 1))
+        frame_times = np.append(timestamps, timestamps[-1] + frame_period)
+
+        self.insert([{**whisker_key,
+                      'bout_onsets': onsets[bounds[w]:bounds[w + 1]],
+                      'bout_offsets': offsets[bounds[w]:bounds[w + 1]],
+                      'bout_onset_times': frame_times[onsets[bounds[w]:bounds[w + 1]]],
+                      'bout_offset_times': frame_times[offsets[bounds[w]:bounds[w + 1]]]}
+                     for w, whisker_key in enumerate(whisker_keys)])
+
+
+# ---- Time-chunked whisker data ----
+
+@schema
+class TrackingChunk(dj.Computed):
+    definition = """
+    # Whisker tracking and processed whisker data of a Tracking, split in fixed-duration chunks (see fetch_window)
+    -> Tracking
+    ---
+    chunk_duration:     float       # (s) duration of the chunks
+    chunk_count:        int         # number of chunks
+    """
+
+    class Chunk(dj.Part):
+        definition = """
+        -> master
+        chunk_idx:      int
+        ---
+        start_frame:    int         # first frame of the chunk
+        stop_frame:     int         # last frame of the chunk (exclusive)
+        start_time:     double      # (s) session clock - time of the first frame
+        stop_time:      double      # (s) session clock - time of the last frame
+        timestamps:     longblob    # (s) session clock - (frames,) timestamps of the chunk
+        """
+
+    class WhiskerChunk(dj.Part):
+        definition = """
+        -> master.Chunk
+        -> ProcessedWhisker
+        ---
+        angle:          longblob
+        curvature:      longblob
+        face_x:         longblob
+        face_y:         longblob
+        follicle_x:     longblob
+        follicle_y:     longblob
+        tip_x:          longblob
+        tip_y:          longblob
+        amplitude:      longblob
+        velocity:       longblob
+        set_point:      longblob
+        angle_raw:      longblob
+        angle_bp:       longblob
+        frequency:      longblob
+        phase:          longblob
+        """
+
+    chunk_duration = 10  # (s)
+
+    tracking_variables = ('angle', 'curvature', 'face_x', 'face_y', 'follicle_x', 'follicle_y', 'tip_x', 'tip_y')
+    processed_variables = ('amplitude', 'velocity', 'set_point', 'angle_raw', 'angle_bp', 'frequency', 'phase')
+
+    key_source = Tracking & ProcessedWhisker
+
     def make(self, key):
-        # call whisker processing function here
-        pass
+        timestamps = TrackingSync.get_timestamps(key)
+        bounds = np.searchsorted(timestamps, timestamps[0] + np.arange(
+            int((timestamps[-1] - timestamps[0]) // self.chunk_duration) + 1) * self.chunk_duration)
+        bounds = np.unique(np.append(bounds, len(timestamps)))  # no empty chunk over tracking gaps
+
+        # raw "angle" from WhiskerTracking only - ProcessedWhisker also has an "angle" attribute
+        whiskers = (Tracking.WhiskerTracking * ProcessedWhisker.proj(*self.processed_variables) & key).fetch(
+            'whisker_idx', *self.tracking_variables, *self.processed_variables, order_by='whisker_idx', as_dict=True)
+
+        self.insert1({**key, 'chunk_duration': self.chunk_duration, 'chunk_count': len(bounds) - 1})
+        self.Chunk.insert([{**key, 'chunk_idx': c, 'start_frame': start, 'stop_frame': stop,
+                            'start_time': timestamps[start], 'stop_time': timestamps[stop - 1],
+                            'timestamps': timestamps[start:stop]}
+                           for c, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))])
+        for whisker in whiskers:
+            variables = {v: np.asarray(whisker[v], dtype=np.float32).ravel()
+                         for v in self.tracking_variables + self.processed_variables}
+            self.WhiskerChunk.insert([{**key, 'whisker_idx': whisker['whisker_idx'], 'chunk_idx': c,
+                                       **{v: x[start:stop] for v, x in variables.items()}}
+                                      for c, (start, stop) in enumerate(zip(bounds[:-1], bounds[1:]))])
+
+    @classmethod
+    def fetch_window(cls, key, t0, t1, variables=('angle',)):
+        """
+        Fetch the whisker data of a Tracking within time windows, reading only the chunks overlapping the windows
+        :param key: key of a TrackingChunk (may be restricted further, e.g. by whisker_idx)
+        :param t0, t1: (s) session clock - start and end of the window(s), scalars or (windows,) arrays
+        :param variables: WhiskerChunk variables to fetch
+        :return: dict with "whisker_idx", "timestamps" and the (whiskers x frames) variables -
+            a list of such dict (one per window) for array-like t0, t1
+        """
+        t0, t1 = np.broadcast_arrays(np.asarray(t0, dtype=float), np.asarray(t1, dtype=float))
+        variables = [variables] if isinstance(variables, str) else list(variables)
+
+        # chunk index - overlapping chunks of each window
+        chunk_idx, start_times, stop_times = (cls.Chunk & key).fetch(
+            'chunk_idx', 'start_time', 'stop_time', order_by='chunk_idx')
+        first = np.searchsorted(stop_times, t0.ravel(), side='left')
+        last = np.searchsorted(start_times, t1.ravel(), side='right')
+        needed = np.unique(np.concatenate([np.arange(f, l) for f, l in zip(first, last)] + [[]]).astype(int))
+
+        chunks = [{'chunk_idx': c} for c in chunk_idx[needed]]
+        timestamps = (cls.Chunk & key & chunks).fetch('timestamps', order_by='chunk_idx') if chunks else []
+        whisker_data = (cls.WhiskerChunk & key & chunks).fetch(
+            'whisker_idx', *variables, order_by='whisker_idx, chunk_idx', as_dict=True) if chunks else []
+
+        # concatenate the chunks - chunk_idx are consecutive frames, "needed" may have gaps between windows
+        timestamps = np.concatenate(timestamps) if len(timestamps) else np.array([])
+        whisker_idx = np.unique([d['whisker_idx'] for d in whisker_data]).astype(int)
+        data = {v: np.vstack([np.concatenate([d[v] for d in whisker_data if d['whisker_idx'] == w])
+                              for w in whisker_idx]) if len(whisker_idx) else np.empty((0, 0))
+                for v in variables}
+
+        windows = []
+        for w0, w1 in zip(t0.ravel(), t1.ravel()):
+            start, stop = np.searchsorted(timestamps, [w0, w1], side='left')
+            windows.append({'whisker_idx': whisker_idx, 'timestamps': timestamps[start:stop],
+                            **{v: x[:, start:stop] for v, x in data.items()}})
+
+        return windows if t0.ndim else windows[0]
 
 
 # ---- Processed object data ----
@@ -166,19 +410,481 @@ class WhiskerObjectDistance(dj.Computed):
     -> Tracking.ObjectTracking
     -> Tracking.WhiskerTracking
     ---
-    distance: longblob  #  euclidean distance over time between a whisker and an object, relative to animal's face
+    distance: longblob  #  euclidean distance over time between a whisker (follicle-tip segment) and an object
+    touch_onsets: longblob   # (touches,) frame index of the onset of each touch (distance below touch_threshold)
+    touch_offsets: longblob  # (touches,) frame index of the offset of each touch (exclusive)
     """
 
+    touch_threshold = 5  # (px) whisker-object distance below which the whisker is considered touching the object
+
+    # computed per Tracking: all whisker / object pairs at once
+    key_source = Tracking & Tracking.ObjectTracking & Tracking.WhiskerTracking
+
     def make(self, key):
-        # example code
-        obj_x, obj_y = (Tracking.ObjectTracking & key).fetch1('object_x', 'object_y')
-        fol_x, fol_y, face_x, face_y = (Tracking.ObjectTracking & key).fetch1(
-            'follicle_x', 'follicle_y', 'face_x', 'face_y')
+        obj_keys, obj_x, obj_y = (Tracking.ObjectTracking & key).fetch(
+            'KEY', 'object_x', 'object_y', order_by='object')
+        whisker_keys, fol_x, fol_y, tip_x, tip_y = (Tracking.WhiskerTracking & key).fetch(
+            'KEY', 'follicle_x', 'follicle_y', 'tip_x', 'tip_y', order_by='whisker_idx')
+
+        obj_x, obj_y, fol_x, fol_y, tip_x, tip_y = (np.vstack([np.asarray(v, dtype=np.float32).ravel() for v in var])
+                                                    for var in (obj_x, obj_y, fol_x, fol_y, tip_x, tip_y))
+
+        # (whiskers x objects x frames) - distance of the objects to the nearest point of the whisker shaft,
+        # approximated by the follicle-tip segment (touches happen along the shaft, mostly near the tip)
+        dist = get_segment_distance(fol_x[:, None], fol_y[:, None], tip_x[:, None], tip_y[:, None],
+                                    obj_x[None], obj_y[None]).astype(np.float32)
+
+        pair_idx, onsets, offsets = _get_intervals(dist.reshape(-1, dist.shape[-1]) < self.touch_threshold)
+        bounds = np.searchsorted(pair_idx, np.arange(dist.shape[0] * dist.shape[1] + 1))
+
+        entries = []
+        for p, (w, o) in enumerate(np.ndindex(*dist.shape[:2])):
+            entries.append({**key, **obj_keys[o], **whisker_keys[w], 'distance': dist[w, o],
+                            'touch_onsets': onsets[bounds[p]:bounds[p + 1]],
+                            'touch_offsets': offsets[bounds[p]:bounds[p + 1]]})
+
+        self.insert(entries)
+
+
+# ========= HELPER METHODS ======
+
+
+def get_segment_distance(x0, y0, x1, y1, x, y):
+    """
+    Euclidean distance of points (x, y) to the segments from (x0, y0) to (x1, y1) - all arguments broadcast
+    NaN where any coordinate is NaN
+    """
+    dx, dy = x1 - x0, y1 - y0
+    length_sq = np.asarray(dx ** 2 + dy ** 2, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.clip(np.where(length_sq > 0, ((x - x0) * dx + (y - y0) * dy) / length_sq, 0), 0, 1)
+    return np.hypot(x0 + t * dx - x, y0 + t * dy - y)
+
+
+def process_whisker_angles(angle_raw, fs, params, gpass=3, gstop=20, transition_ratio=2, phase_filter_order=2):
+    """
+    Whisker angle processing, for all whiskers at once
+    Zero-phase (forward-backward) Butterworth filtering of the angle for the set point (low-pass),
+    the band-passed angle and the band-passed input to the Hilbert transform (amplitude, phase and frequency)
+    Set point and angle filters: order and natural frequencies from buttord(Wp, Ws, gpass, gstop), the stored edges
+     being the -gpass dB edges and the other edges transition_ratio beyond them (below the low edges, above the
+     high edges). Phase filter: Butterworth of order phase_filter_order at the stored edges (WhiskerProcessingParams)
+    :param angle_raw: (whiskers x frames) angle values (no NaN)
+    :param fs: (Hz) sampling rate
+    :param params: WhiskerProcessingParams entry
+    :param gpass: (dB) max passband ripple
+    :param gstop: (dB) min stopband attenuation
+    :param transition_ratio: frequency ratio of the transition bands of the buttord designs
+    :param phase_filter_order: order of the Butterworth filter applied before the Hilbert transform
+    :return: dict of (whiskers x frames) arrays - angle_raw, set_point, angle_bp, amplitude, phase, frequency, velocity
+    """
+    angle_raw = np.atleast_2d(np.asarray(angle_raw, dtype=float))
+    n_frames = angle_raw.shape[-1]
+    nyquist = fs / 2
+
+    def _filtfilt(sos):
+        return sc_signal.sosfiltfilt(sos, angle_raw, axis=-1)
+
+    def _buttord_sos(passband, stopband, btype):
+        order, wn = sc_signal.buttord(passband, stopband, gpass, gstop, fs=fs)
+        return sc_signal.butter(order, wn, btype=btype, fs=fs, output='sos')
+
+    set_point_edge = float(params['set_point'])
+    angle_band = np.array([float(params['angle_passband']), float(params['angle_stopband'])])
+    phase_band = [float(params['phase_passband']), float(params['phase_stopband'])]
+
+    set_point = _filtfilt(_buttord_sos(set_point_edge, min(set_point_edge * transition_ratio, 0.99 * nyquist),
+                                       'lowpass'))
+    angle_bp = _filtfilt(_buttord_sos(angle_band, [angle_band[0] / transition_ratio,
+                                                   min(angle_band[1] * transition_ratio, 0.99 * nyquist)],
+                                      'bandpass'))
+    phase_bp = _filtfilt(sc_signal.butter(phase_filter_order, phase_band, btype='bandpass', fs=fs, output='sos'))
+
+    # hilbert transform - padded to a fast FFT length
+    analytic = sc_signal.hilbert(phase_bp, N=sc_fft.next_fast_len(n_frames), axis=-1)[..., :n_frames]
+    amplitude = np.abs(analytic)
+    phase = np.angle(analytic)
+    frequency = np.gradient(np.unwrap(phase, axis=-1), axis=-1) * fs / (2 * np.pi)
+
+    velocity = np.gradient(angle_raw, axis=-1) * fs
+
+    return {'angle_raw': angle_raw, 'set_point': set_point, 'angle_bp': angle_bp,
+            'amplitude': amplitude, 'phase': phase, 'frequency': frequency, 'velocity': velocity}
+
+
+def clean_whisker_angles(angles, outlier_window=20, smoothing_window=7, chunk_size=2 ** 18):
+    """
+    Python port of the Matlab pre-processing of the whisker angles (WhiskerAngleSmoothFill.m)
+        1/ find and replace outliers - filloutliers(thetas, 'spline', 'movmedian', 20)
+        2/ smooth values - smoothdata(thetas, 'rloess', 7)
+        3/ fill missing / NaNs values - fillmissing(thetas, 'spline', 'EndValues', 'nearest')
+    :param angles: (whiskers x frames) tracked angles
+    :param chunk_size: number of frames processed at once by the moving median (bounds memory usage)
+    :return: (whiskers x frames) cleaned angles
+    """
+    angles = np.atleast_2d(np.asarray(angles, dtype=float))
+    angles = fill_outliers(angles, window=outlier_window, chunk_size=chunk_size)
+    angles = smooth_rloess(angles, window=smoothing_window)
+    return fill_missing(angles)
+
+
+def fill_outliers(x, window=20, threshold=3, chunk_size=2 ** 18):
+    """
+    Replace outliers by spline interpolation - as Matlab's filloutliers(x, 'spline', 'movmedian', window)
+    Outliers are the values more than `threshold` local scaled MAD away from the local (moving) median
+    :param x: (rows x frames) array - NaNs are ignored and left in place
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    # Matlab moving window convention: for an even window, one more element before than after
+    before, after = window // 2, (window - 1) // 2
+
+    outliers = np.zeros(x.shape, dtype=bool)
+    for start, stop in _iter_chunks(x.shape[-1], chunk_size):
+        windows = _sliding_windows(x, start, stop, before, after)
+        med = _nanmedian_last(windows)
+        mad = 1.4826 * _nanmedian_last(np.abs(windows - med[..., None]))
+        outliers[:, start:stop] = np.abs(x[:, start:stop] - med) > threshold * mad
+
+    return _spline_fill(x, outliers)
+
+
+def smooth_rloess(x, window=7, iterations=5):
+    """
+    Robust local quadratic regression smoothing - as Matlab's smoothdata(x, 'rloess', window)
+    Each point is the value at 0 of a weighted quadratic fit over its window (tricube distance weights),
+    repeated with bisquare robustness weights computed from the residuals (scaled by their MAD)
+    The weighted sums of all the local fits are obtained by correlation with the (tricube x offset^k) kernels,
+    and the 3 x 3 systems are solved in closed form, for all points at once.
+    :param x: (rows x frames) array - NaNs are ignored (and replaced when their window has data)
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    robust = (~np.isnan(x)).astype(float)
+
+    for it in range(iterations + 1):
+        smoothed = _weighted_loess(x, robust, window)
+        if it == iterations:
+            break
+
+        # bisquare robustness weights
+        resid = x - smoothed
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)  # all-NaN rows
+            mad = np.nanmedian(np.abs(resid), axis=-1, keepdims=True)
+        r = np.nan_to_num(resid / (6 * np.where(mad > 0, mad, 1)), nan=1)
+        robust = np.where(np.abs(r) < 1, (1 - r ** 2) ** 2, 0)
+
+    return smoothed
+
+
+def _weighted_loess(x, weights, window):
+    """
+    One local quadratic regression pass of `smooth_rloess`, with per-point (robustness) weights
+    """
+    half = window // 2
+    offsets = np.arange(-half, window - half, dtype=float)
+    tricube = (1 - np.abs(offsets / (np.abs(offsets).max() + 1)) ** 3) ** 3
+
+    weights = np.where(np.isnan(x), 0, weights)
+    wy = weights * np.nan_to_num(x)
+
+    # windowed sums of w * offset^k and of w * y * offset^k - zero outside of x (shrinking windows at the ends)
+    s0, s1, s2, s3, s4 = (ndimage.correlate1d(weights, tricube * offsets ** k, axis=-1, mode='constant')
+                          for k in range(5))
+    t0, t1, t2 = (ndimage.correlate1d(wy, tricube * offsets ** k, axis=-1, mode='constant')
+                  for k in range(3))
+
+    # intercept of the weighted quadratic fit (Cramer's rule)
+    det = s0 * (s2 * s4 - s3 * s3) - s1 * (s1 * s4 - s3 * s2) + s2 * (s1 * s3 - s2 * s2)
+    num = t0 * (s2 * s4 - s3 * s3) - s1 * (t1 * s4 - s3 * t2) + s2 * (t1 * s3 - s2 * t2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        singular = np.abs(det) <= 1e-9 * np.abs(s0 * s2 * s4)
+        # not enough points for a quadratic - weighted mean
+        return np.where(singular, np.where(s0 > 0, t0 / s0, np.nan), num / det)
+
+
+def fill_missing(x):
+    """
+    Fill NaNs by spline interpolation, and the leading / trailing NaNs with the nearest value
+    - as Matlab's fillmissing(x, 'spline', 'EndValues', 'nearest')
+    :param x: (rows x frames) array
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    missing = np.isnan(x)
+    if not missing.any():
+        return x
+
+    # end values - nearest valid value
+    frames = np.arange(x.shape[-1])
+    first_valid = np.argmax(~missing, axis=-1)
+    last_valid = x.shape[-1] - 1 - np.argmax(~missing[:, ::-1], axis=-1)
+    rows = np.arange(x.shape[0])[:, None]
+    leading, trailing = frames < first_valid[:, None], frames > last_valid[:, None]
+    x = np.where(leading, x[rows[:, 0], first_valid][:, None], x)
+    x = np.where(trailing, x[rows[:, 0], last_valid][:, None], x)
+
+    return _spline_fill(x, np.isnan(x))
+
+
+def _spline_fill(x, fill_mask):
+    """
+    Replace the values of x at `fill_mask` by cubic spline interpolation of the other (non-NaN) values, per row
+    """
+    x = x.copy()
+    frames = np.arange(x.shape[-1])
+    for row, mask in zip(x, fill_mask):
+        if not mask.any():
+            continue
+        known = ~mask & ~np.isnan(row)
+        if known.sum() < 2:
+            continue
+        row[mask] = CubicSpline(frames[known], row[known])(frames[mask])
+    return x
+
+
+def _nanmedian_last(x):
+    """
+    Median along the last axis ignoring NaNs - sort based, much faster than np.nanmedian for short windows
+    """
+    x = np.sort(x, axis=-1)  # NaNs last
+    n_valid = (~np.isnan(x)).sum(axis=-1, keepdims=True)
+    lo = np.take_along_axis(x, np.maximum((n_valid - 1) // 2, 0), axis=-1)[..., 0]
+    hi = np.take_along_axis(x, np.maximum(n_valid // 2, 0), axis=-1)[..., 0]
+    return np.where(n_valid[..., 0] > 0, (lo + hi) / 2, np.nan)
+
+
+def _iter_chunks(n_frames, chunk_size):
+    for start in range(0, n_frames, chunk_size):
+        yield start, min(start + chunk_size, n_frames)
+
+
+def _sliding_windows(x, start, stop, before, after):
+    """
+    (rows x (stop - start) x (before + 1 + after)) windows around frames [start, stop) - NaN outside of x
+    """
+    padded = np.pad(x[:, max(start - before, 0):min(stop + after, x.shape[-1])],
+                    ((0, 0), (max(before - start, 0), max(stop + after - x.shape[-1], 0))),
+                    constant_values=np.nan)
+    return sliding_window_view(padded, before + 1 + after, axis=-1)
+
+
+def _get_intervals(mask):
+    """
+    Run-length encoding of the True runs of a boolean (rows x frames) mask, for all rows at once
+    :return: row_idx, onsets, offsets (exclusive) of each run - sorted by row then onset
+    """
+    mask = np.atleast_2d(mask).astype(np.int8)
+    edges = np.diff(np.pad(mask, ((0, 0), (1, 1))), axis=-1)
+    on_rows, onsets = np.nonzero(edges == 1)
+    _, offsets = np.nonzero(edges == -1)
+    return on_rows, onsets, offsets
+
+
+def fit_clock_sync(device_pulses, session_pulses, match_tolerance=0.05, knot_interval=60, max_candidates=50,
+                   offset=None, initial_window=60, min_match_fraction=0.9, max_residual_rms=0.01, max_iter=20):
+    """
+    Match the TTL pulses shared by two streams and fit a piecewise-linear (drift) mapping of the device clock
+     to the session clock
+    1/ offset: the candidate offset (from the pairwise differences of the first pulses) matching the most
+     pulses of the initial window - rejected if another candidate matches about as many (e.g. periodic pulses),
+     unless an approximate offset is given
+    2/ linear clock rate: match -> fit -> re-match on a window widened two-fold at each step, from the first
+     initial_window (s) to all the pulses - the drift accumulated over a step stays well within match_tolerance
+    3/ least-squares piecewise-linear fit, knots every knot_interval (s) - linear (hat function) basis,
+     iterated (match -> fit -> re-match) until the matched pulses stop changing
+    :param device_pulses: (s) pulse times, device clock
+    :param session_pulses: (s) pulse times, session clock
+    :param match_tolerance: (s) max distance between matched pulses
+    :param knot_interval: (s) interval between the knots of the piecewise-linear mapping
+    :param max_candidates: number of first pulses of each stream used for the offset candidates
+    :param offset: (s) approximate session - device clock offset, within half the pulse interval - required
+     for periodic pulse trains, whose offset is ambiguous
+    :param initial_window: (s) device clock duration of the pulses used for the offset and the first rate estimate
+    :param min_match_fraction: min fraction of the pulses of the shorter stream to be matched
+    :param max_residual_rms: (s) max rms residual of the matched pulses
+    :param max_iter: max number of match -> fit iterations of the piecewise-linear fit
+    :return: dict - pulse_count, device_knots, session_knots, residual_rms
+    """
+    device_pulses = np.sort(np.asarray(device_pulses, dtype=float).ravel())
+    session_pulses = np.sort(np.asarray(session_pulses, dtype=float).ravel())
+    if len(device_pulses) < 2 or len(session_pulses) < 2:
+        raise ValueError('At least 2 pulses per stream are required for the clock synchronization')
+
+    # 1/ offset - number of matches of each candidate over the initial window, evaluated at once
+    test_pulses = device_pulses[device_pulses <= device_pulses[0] + initial_window]
+    if offset is None:
+        candidates = np.unique((session_pulses[:max_candidates, None]
+                                - device_pulses[None, :max_candidates]).ravel())
+        match_counts = (np.abs(_nearest_diff(test_pulses[None, :] + candidates[:, None], session_pulses))
+                        <= match_tolerance).sum(axis=1)
+        best = np.argmax(match_counts)
+        offset = candidates[best]
+        # runner-up among the candidates of a distinct offset
+        distinct = np.abs(candidates - offset) > 2 * match_tolerance
+        if distinct.any() and match_counts[distinct].max() >= 0.8 * match_counts[best]:
+            raise ValueError('Ambiguous TTL pulse offset ({} vs {} matches at {:.3f} and {:.3f} s) - periodic pulses?'
+                             ' Provide an approximate offset'.format(
+                                 match_counts[best], match_counts[distinct].max(), offset,
+                                 candidates[distinct][np.argmax(match_counts[distinct])]))
+
+    # 2/ linear clock rate, on a widening window
+    slope, intercept = 1., offset
+    window = initial_window
+    while True:
+        in_window = device_pulses <= device_pulses[0] + window
+        device_idx, session_idx = _match_pulses(device_pulses[in_window] * slope + intercept,
+                                                session_pulses, match_tolerance)
+        if len(device_idx) < 2:
+            raise ValueError('Unable to match the TTL pulses of the two streams')
+        slope, intercept = np.polyfit(device_pulses[device_idx], session_pulses[session_idx], 1)
+        if in_window.all():
+            break
+        window *= 2
+
+    # 3/ piecewise-linear drift, until the matched pulses stop changing
+    device_knots = np.array([device_pulses[0], device_pulses[-1]])
+    session_knots = device_knots * slope + intercept
+    previous = None
+    for _ in range(max_iter):
+        matched = _match_pulses(sync_times(device_pulses, device_knots, session_knots),
+                                session_pulses, match_tolerance)
+        if previous is not None and all(np.array_equal(m, p) for m, p in zip(matched, previous)):
+            break
+        previous = matched
+        device_matched, session_matched = device_pulses[matched[0]], session_pulses[matched[1]]
+        if len(device_matched) < 2:
+            raise ValueError('Unable to match the TTL pulses of the two streams')
+
+        knot_count = max(2, int(np.ceil((device_matched[-1] - device_matched[0]) / knot_interval)) + 1)
+        device_knots = np.linspace(device_matched[0], device_matched[-1], knot_count)
+        if len(device_matched) < 2 * knot_count:
+            device_knots = device_knots[[0, -1]]
+        basis = _hat_basis(device_matched, device_knots)
+        session_knots = np.linalg.lstsq(basis, session_matched, rcond=None)[0]
+
+    residual = session_matched - _hat_basis(device_matched, device_knots) @ session_knots
+    residual_rms = float(np.sqrt(np.mean(residual ** 2)))
+    match_fraction = len(device_matched) / min(len(device_pulses), len(session_pulses))
+
+    if match_fraction < min_match_fraction or residual_rms > max_residual_rms:
+        raise ValueError('Clock synchronization failed: {}/{} pulses matched ({:.0%}, min {:.0%}),'
+                         ' rms residual {:.2g} s (max {:.2g} s)'.format(
+                             len(device_matched), min(len(device_pulses), len(session_pulses)),
+                             match_fraction, min_match_fraction, residual_rms, max_residual_rms))
+
+    return {'pulse_count': len(device_matched),
+            'device_knots': device_knots,
+            'session_knots': session_knots,
+            'residual_rms': residual_rms}
+
+
+def sync_times(times, device_knots, session_knots):
+    """
+    Vectorized conversion of device clock times to the session clock - piecewise-linear mapping,
+     linearly extrapolated beyond the first and last knots
+    """
+    times = np.asarray(times, dtype=float)
+    synced = np.interp(times, device_knots, session_knots)
+    slopes = np.diff(session_knots) / np.diff(device_knots)
+    before, after = times < device_knots[0], times > device_knots[-1]
+    synced[before] = session_knots[0] + (times[before] - device_knots[0]) * slopes[0]
+    synced[after] = session_knots[-1] + (times[after] - device_knots[-1]) * slopes[-1]
+    return synced
+
+
+def _nearest_diff(x, ref):
+    """
+    Signed difference between each element of x and the nearest element of the sorted ref array
+    """
+    idx = np.clip(np.searchsorted(ref, x), 1, len(ref) - 1)
+    before, after = x - ref[idx - 1], ref[idx] - x
+    return np.where(before < after, before, -after)
+
+
+def _match_pulses(x, ref, tolerance):
+    """
+    Mutually nearest pairs of pulses of the sorted x and ref arrays, within tolerance
+    :return: x_idx, ref_idx of the matched pulses
+    """
+    ref_idx = np.clip(np.searchsorted(ref, x), 1, len(ref) - 1)
+    ref_idx -= (x - ref[ref_idx - 1]) < (ref[ref_idx] - x)
+    x_idx = np.clip(np.searchsorted(x, ref), 1, len(x) - 1)
+    x_idx -= (ref - x[x_idx - 1]) < (x[x_idx] - ref)
+
+    matched = (x_idx[ref_idx] == np.arange(len(x))) & (np.abs(ref[ref_idx] - x) <= tolerance)
+    return np.flatnonzero(matched), ref_idx[matched]
+
+
+def _hat_basis(x, knots):
+    """
+    (points x knots) linear B-spline (hat function) basis at x - row sums equal 1 within the knot range
+    """
+    seg = np.clip(np.searchsorted(knots, x, side='right') - 1, 0, len(knots) - 2)
+    frac = (x - knots[seg]) / (knots[seg + 1] - knots[seg])
+    basis = np.zeros((len(x), len(knots)))
+    basis[np.arange(len(x)), seg] = 1 - frac
+    basis[np.arange(len(x)), seg + 1] = frac
+    return basis
+
+
+def get_bouts(x, high_threshold, low_threshold, min_gap=0, min_duration=0):
+    """
+    Hysteresis thresholding of (rows x frames) traces, for all rows at once: runs above low_threshold
+     that reach high_threshold, merged across gaps shorter than min_gap, then longer than min_duration
+    :param min_gap: (frames) bouts separated by shorter gaps are merged
+    :param min_duration: (frames) shorter bouts (after merging) are discarded
+    :return: row_idx, onsets, offsets (exclusive) of each bout - sorted by row then onset
+    """
+    x = np.atleast_2d(x)
+    row_idx, onsets, offsets = _get_intervals(x > low_threshold)
+
+    # keep the runs reaching the high threshold - count of frames above it within each run
+    high_count = np.pad(np.cumsum(x > high_threshold, axis=-1), ((0, 0), (1, 0)))
+    is_bout = high_count[row_idx, offsets] > high_count[row_idx, onsets]
+    row_idx, onsets, offsets = row_idx[is_bout], onsets[is_bout], offsets[is_bout]
+
+    # merge across short gaps - a new bout starts at a row change or after a long enough gap
+    is_start = np.ones(len(onsets), dtype=bool)
+    is_start[1:] = (row_idx[1:] != row_idx[:-1]) | (onsets[1:] - offsets[:-1] >= min_gap)
+    is_end = np.roll(is_start, -1)
+    row_idx, onsets, offsets = row_idx[is_start], onsets[is_start], offsets[is_end]
+
+    is_long = offsets - onsets >= min_duration
+    return row_idx[is_long], onsets[is_long], offsets[is_long]
+
+
+def get_interval_idx(times, onsets, offsets):
+    """
+    Interval join of times (e.g. spike times) with sorted, non-overlapping intervals (e.g. whisking bouts)
+    :param onsets, offsets: (intervals,) interval onsets and offsets (exclusive)
+    :return: (times,) index of the interval containing each time, -1 outside of all intervals
+    """
+    times = np.asarray(times)
+    if not len(onsets):
+        return np.full(times.shape, -1)
+    idx = np.searchsorted(onsets, times, side='right') - 1
+    inside = (idx >= 0) & (times < np.asarray(offsets)[np.maximum(idx, 0)])
+    return np.where(inside, idx, -1)
+
+
+def get_interval_overlap(starts, stops, onsets, offsets):
+    """
+    Total overlap of [start, stop) windows (e.g. trials) with sorted, non-overlapping intervals (e.g. whisking bouts)
+    Computed from the cumulative interval duration function, without looping over windows or intervals
+    :param starts, stops: (windows,) window bounds
+    :param onsets, offsets: (intervals,) interval onsets and offsets (exclusive)
+    :return: (windows,) overlap duration of each window with the intervals
+    """
+    onsets, offsets = np.asarray(onsets, dtype=float), np.asarray(offsets, dtype=float)
+    cum_duration = np.concatenate([[0], np.cumsum(offsets - onsets)])
 
-        face_pos = np.array([face_x, face_y])
-        obj_pos = np.array([obj_x, obj_y])
-        fol_pos = np.array([fol_x, fol_y])
+    if not len(onsets):
+        return np.zeros(np.shape(starts))
 
-        dist = np.linalg.norm((fol_pos - face_pos) - (obj_pos - face_pos), axis=0)
+    def _duration_before(t):
+        # total interval duration before t: full intervals before the last interval starting before t,
+        # plus the part of that last interval before t
+        idx = np.searchsorted(onsets, t, side='right')
+        last = np.maximum(idx - 1, 0)
+        return cum_duration[last] + np.clip(t - onsets[last], 0, (offsets - onsets)[last]) * (idx > 0)
 
-        self.insert1({**key, 'distance': dist})
+    return _duration_before(np.asarray(stops, dtype=float)) - _duration_before(np.asarray(starts, dtype=float))
@@ -1,6 +1,10 @@
 import numpy as np
 
 from . import (experiment, psth, ephys)
+from . import LRUCache
+
+
+_trial_event_cache = LRUCache(maxsize=256)  # (trial_cond_name, sessions, events) -> (trials, trials x events times)
 
 
 def _get_trial_event_times(events, units, trial_cond_name):
@@ -9,29 +13,86 @@ def _get_trial_event_times(events, units, trial_cond_name):
     For trials with multiple events of the same type, use the one occurred last
     :param events: list of events
     """
-    events = list(events) + ['go']
+    requested = set(events)
+    events = list(dict.fromkeys(list(events) + ['go']))
 
-    tr_OI = (psth.TrialCondition().get_trials(trial_cond_name) & units).proj()
-    tr_events = {}
-    for eve in events:
-        if eve not in tr_events:
-            tr_events[eve] = (tr_OI.aggr(
-                experiment.TrialEvent & {'trial_event_type': eve}, trial_event_id='max(trial_event_id)')
-                              * experiment.TrialEvent).fetch('trial_event_time', order_by='trial')
+    trials, event_times = _get_trial_event_matrix(events, units, trial_cond_name)
 
+    go_times = event_times[:, events.index('go')]
     present_events, event_starts = [], []
-    for etype, etime in tr_events.items():
-        if etype in events[:-1]:
-            present_events.append(etype)
-            event_starts.append(np.nanmedian(etime.astype(float) - tr_events["go"].astype(float)))
+    for eve_idx, eve in enumerate(events):
+        if eve not in requested:  # 'go' is only returned (median 0) if requested
+            continue
+        etime = event_times[:, eve_idx]
+        if np.isnan(etime).all():
+            continue
+        present_events.append(eve)
+        event_starts.append(np.nanmedian(etime - go_times))
 
     return np.array(present_events), np.array(event_starts)
 
 
+def _get_trial_event_matrix(events, units, trial_cond_name):
+    """
+    Fetch, in one query, the times of the specified trial event types for all trials of "trial_cond_name"
+    in the sessions of "units" - cached per (condition, sessions, events), copies of the cached arrays are returned
+    For trials with multiple events of the same type, use the one occurred last
+    :param events: list of trial event types
+    :return: trials (trials x 3 [subject_id, session, trial]), event times (trials x events) - NaN if absent
+    """
+    sessions = _get_units_sessions(units)
+    cache_key = (trial_cond_name, sessions, tuple(events))
+    if cache_key in _trial_event_cache:
+        trials, event_times = _trial_event_cache[cache_key]
+        return trials.copy(), event_times.copy()
+
+    tr_OI = psth.TrialCondition.get_trials(trial_cond_name, [
+        {'subject_id': subj, 'session': sess} for subj, sess in sessions])
+
+    # trial_event_time is a decimal - multiplying by a double literal returns doubles from MySQL
+    subj, sess, trial, eve_type, eve_id, eve_time = (
+            experiment.TrialEvent & tr_OI & [{'trial_event_type': eve} for eve in events]).proj(
+        'trial_event_type', t='trial_event_time * 1e0').fetch(
+        'subject_id', 'session', 'trial', 'trial_event_type', 'trial_event_id', 't')
+
+    trials = tr_OI.fetch('subject_id', 'session', 'trial', order_by='subject_id, session, trial')
+    trials = np.array(list(zip(*trials)), dtype=object).reshape(-1, 3)
+    event_times = np.full((len(trials), len(events)), np.nan)
+
+    if len(eve_time):
+        # pivot to trials x events - sorted by (trial, event type, event id), only the last event of each
+        #  (trial, event type) group is written (repeated fancy-index writes have no guaranteed order)
+        trial_idx = {tuple(tr): i for i, tr in enumerate(trials)}
+        eve_idx = {eve: i for i, eve in enumerate(events)}
+        rows = np.array([trial_idx[tr] for tr in zip(subj, sess, trial)])
+        cols = np.array([eve_idx[eve] for eve in eve_type])
+        order = np.lexsort((eve_id.astype(int), cols, rows))
+        rows, cols = rows[order], cols[order]
+        last = np.append((rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1]), True)
+        event_times[rows[last], cols[last]] = eve_time[order][last].astype(float)
+
+    _trial_event_cache[cache_key] = (trials, event_times)
+    return trials.copy(), event_times.copy()
+
+
+def _get_units_sessions(units):
+    """
+    Return the sorted (subject_id, session) tuples of the specified units
+    :param units: either a list of unit_keys or a query of the ephys.Unit table
+    """
+    if isinstance(units, (list, tuple)):
+        sessions = {(u['subject_id'], u['session']) for u in units}
+    else:
+        sessions = set(zip(*(experiment.Session & units).fetch('subject_id', 'session')))
+    return tuple(sorted(sessions))
+
+
 def _get_stim_onset_time(units, trial_cond_name):
+    trials = psth.TrialCondition.get_trials(trial_cond_name, [
+        {'subject_id': subj, 'session': sess} for subj, sess in _get_units_sessions(units)])
     stim_onsets = (experiment.PhotostimEvent.proj('photostim_event_time')
                    * (experiment.TrialEvent & 'trial_event_type="go"').proj(go_time='trial_event_time')
-                   & psth.TrialCondition().get_trials(trial_cond_name) & units).proj(
+                   & trials & units).proj(
         stim_onset_from_go='photostim_event_time - go_time').fetch('stim_onset_from_go')
     return np.nanmean(stim_onsets.astype(float))
 